@@ -0,0 +1,94 @@
+import os
+import sys
+import hashlib
+import numpy as np
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from explorer.database import TRAFFIC_ACCIDENT_SOURCE, database_generation
+from explorer.raster import TrafficAccidentRaster
+
+__all__ = ["ROUTE_RISK_CACHE", "LRUFileBasedCache", "route_risk_cache", "route_risk_key"]
+
+
+"""
+The risk of a route is cached by the grid cells it passes through rather than
+by its points, so routes which differ only by points inside the same cells,
+e.g. after dragging a waypoint back and forth, share one entry. The version
+of the risk data, and of the raster if lookups go through it, is part of the
+key, so an entry is never used after 'Update*Data' has written new data or
+the raster has been rebuilt, and the stale ones are culled later.
+"""
+
+# The alias of the cache in 'CACHES' of the settings
+ROUTE_RISK_CACHE = "route_risk"
+
+
+class LRUFileBasedCache(FileBasedCache):
+    """This class is a file based cache which is shared by every worker
+        process on a host, and which culls the least recently used entries
+        instead of random ones when 'MAX_ENTRIES' is reached.
+
+    The modification time of an entry's file is refreshed whenever it is
+    read, so it tells when the entry was last used. The expiry of 'TIMEOUT'
+    is stored in the file itself and is not affected."""
+
+    def get(self, key, default=None, version=None):
+        missing = object()
+        value = super().get(key, missing, version)
+        if value is missing:
+            return default
+        try:
+            os.utime(self._key_to_file(key, version))
+        except OSError:
+            # The entry was culled by another process in the meantime
+            pass
+        return value
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        num_entries = len(filelist)
+        if num_entries < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            return self.clear()
+        filelist.sort(key=_modification_time)
+        for fname in filelist[:int(num_entries / self._cull_frequency)]:
+            self._delete(fname)
+
+def _modification_time(fname):
+    try:
+        return os.stat(fname).st_mtime_ns
+    except OSError:
+        return 0
+
+def route_risk_cache():
+    return caches[ROUTE_RISK_CACHE]
+
+def _risk_data_version():
+    # Writes to other tables, e.g. of sessions, do not change it
+    version = [database_generation()]
+    if TRAFFIC_ACCIDENT_SOURCE == "raster":
+        version.append(TrafficAccidentRaster.get().version)
+    return version
+
+def route_risk_key(*cell_sets):
+    """This method is used to determine the key of a route in the route risk
+        cache from the grid cells it passes through.
+
+    :param *cell_sets: The cell ids of the route at each grid, e.g. of its
+        traffic accidents and of its earthquakes. The order of the cells in a
+        set does not matter.
+    :type *cell_sets: iterables of int
+
+    :return: A stable SHA-1 hash of the sorted cells and the risk data version.
+    :rtype: str"""
+
+    digest = hashlib.sha1()
+    for cells in cell_sets:
+        cells = np.unique(np.asarray(list(cells), dtype=np.int64))
+        digest.update(len(cells).to_bytes(8, "little"))
+        digest.update(cells.astype("<i8").tobytes())
+    digest.update(repr(_risk_data_version()).encode())
+    return f"{ROUTE_RISK_CACHE}:{digest.hexdigest()}"
@@ -2,7 +2,16 @@ import os
 import sys
 import json
 import math
+import hashlib
+import queue
+import atexit
 import sqlite3
+import functools
+import collections
+import concurrent.futures
+import threading
+import time
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
@@ -15,6 +24,10 @@ import explorer.risk as risk
 
 DEGREE_DIFFERENCE = 0.0001
 TRACKING_JSON_PATH = r".\data\tracking.json"
+# Where 'risk_traffic_accident' lookups go: "sqlite" queries the database on
+# every lookup, "memory" probes an index loaded once per worker process and
+# "raster" reads the tiles written by 'raster.build_traffic_accident_raster()'
+TRAFFIC_ACCIDENT_SOURCE = os.getenv("TRAFFIC_ACCIDENT_SOURCE", "sqlite")
 
 def rounding(degree, difference=DEGREE_DIFFERENCE):
     """This method is used to determine rounded values of degrees of latitudes
@@ -22,13 +35,58 @@ def rounding(degree, difference=DEGREE_DIFFERENCE):
         difference, respectively. By default, both latitude and longitude are
         calculated by a constant 'DEGREE_DIFFERENCE' in a value of 0.0001."""
 
-    power = math.log10(difference)
-    if power > 0:
+    decimal_place = _decimal_place(difference)
+    if decimal_place is None:
         return round(float(degree) / difference) * difference
     else:
-        decimal_place = math.ceil(abs(power))
         return round(round(float(degree) / difference) * difference, decimal_place)
 
+@functools.lru_cache(maxsize=None)
+def _decimal_place(difference):
+    # The number of decimal places of a degree difference below 1, which is
+    # only determined once per difference
+    power = math.log10(difference)
+    if power > 0:
+        return None
+    else:
+        return math.ceil(abs(power))
+
+def cell_id(latitude, longitude, difference=DEGREE_DIFFERENCE):
+    """This method is used to pack the grid indexes of a coordinate into a
+        single integer, so that a grid cell can be identified without
+        comparing floats. By default, the grid is in a size of
+        'DEGREE_DIFFERENCE'."""
+
+    latitude_offset = round(90 / difference)
+    longitude_offset = round(180 / difference)
+    latitude_index = round(float(latitude) / difference) + latitude_offset
+    longitude_index = round(float(longitude) / difference) + longitude_offset
+    return latitude_index * (2 * longitude_offset + 1) + longitude_index
+
+def cell_ids(latitudes, longitudes, difference=DEGREE_DIFFERENCE):
+    """This method is the NumPy version of 'cell_id()', which determines the
+        cell ids of arrays of latitudes and longitudes at once."""
+
+    latitude_offset = round(90 / difference)
+    longitude_offset = round(180 / difference)
+    latitude_indexes = np.rint(np.asarray(latitudes, dtype=np.float64) / difference).astype(np.int64)
+    longitude_indexes = np.rint(np.asarray(longitudes, dtype=np.float64) / difference).astype(np.int64)
+    return ((latitude_indexes + latitude_offset) * (2 * longitude_offset + 1)
+            + longitude_indexes + longitude_offset)
+
+def cell_indexes(cells, difference=DEGREE_DIFFERENCE):
+    """This method is used to unpack cell ids into the grid indexes of their
+        latitudes and longitudes, i.e. the degrees divided by 'difference'.
+
+    :return: The latitude indexes and the longitude indexes.
+    :rtype: a tuple of two numpy arrays"""
+
+    latitude_offset = round(90 / difference)
+    longitude_offset = round(180 / difference)
+    cells = np.asarray(cells, dtype=np.int64)
+    latitude_indexes, longitude_indexes = np.divmod(cells, 2 * longitude_offset + 1)
+    return latitude_indexes - latitude_offset, longitude_indexes - longitude_offset
+
 class InvalidCoordinateError(Exception):
     def __init__(self, message="""Invalid coordinate. Must provide either a single
                                  iterable or separate latitude and longitude values."""):
@@ -36,6 +94,10 @@ class InvalidCoordinateError(Exception):
         super().__init__(self.message)
 
 class Coordinate:
+    # A route creates one of these per point, so they have no '__dict__'
+    __slots__ = ("latitude", "longitude", "latitude_grid", "longitude_grid",
+                 "_traffic_accident", "_earthquake")
+
     def __init__(self, *coordinate) -> None:
         """This class is mainly used to determine rounded values of coordinates
             in specific degree difference
@@ -79,10 +141,123 @@ class Coordinate:
             self._earthquake = EarthquakeData(self.latitude_grid, self.longitude_grid)
         return self._earthquake
 
+class CoordinateArray:
+    def __init__(self, coordinates) -> None:
+        """This class is the batch version of 'Coordinate', which validates
+            and rounds all points of a route at once with NumPy.
+
+        A 'Coordinate' is only created when a single point is indexed, e.g.
+            CoordinateArray(coordinates)[0].traffic_accident
+
+        :param coordinates: The latitude values and the longitude values.
+        :type coordinates: an N x 2 array, a list of tuples, or a list of
+            dicts like {"lat": 25.2525, "lng": 123.456}."""
+
+        if isinstance(coordinates, CoordinateArray):
+            array = coordinates.array
+        else:
+            if not isinstance(coordinates, np.ndarray):
+                coordinates = list(coordinates)
+                if coordinates and isinstance(coordinates[0], dict):
+                    try:
+                        coordinates = [(coordinate["lat"], coordinate["lng"]) for coordinate in coordinates]
+                    except (KeyError, TypeError):
+                        raise InvalidCoordinateError()
+            try:
+                array = np.asarray(coordinates, dtype=np.float64)
+            except (TypeError, ValueError):
+                raise InvalidCoordinateError()
+            if array.size == 0:
+                array = array.reshape(0, 2)
+            if array.ndim != 2 or array.shape[1] != 2:
+                message = "Invalid coordinate format. Must provide latitude and longitude values."
+                raise InvalidCoordinateError(message)
+
+            # The comparisons are negated so that NaN is invalid as well
+            invalid = np.flatnonzero(~(np.abs(array[:, 0]) <= 90))
+            if len(invalid):
+                message = f"Invalid latitude value at index {invalid[0]}. Must between -90 and 90 degrees."
+                raise InvalidCoordinateError(message)
+            invalid = np.flatnonzero(~(np.abs(array[:, 1]) <= 180))
+            if len(invalid):
+                message = f"Invalid longitude value at index {invalid[0]}. Must between -180 and 180 degrees."
+                raise InvalidCoordinateError(message)
+
+        self.array = array
+        self.latitudes = array[:, 0]
+        self.longitudes = array[:, 1]
+        self._grids = {}
+        self._cells = {}
+        self._coordinates = {}
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        for index in range(len(self.array)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CoordinateArray(self.array[index])
+        index = range(len(self.array))[index]
+        if index not in self._coordinates:
+            self._coordinates[index] = Coordinate(float(self.latitudes[index]), float(self.longitudes[index]))
+        return self._coordinates[index]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+    def grid(self, difference=DEGREE_DIFFERENCE):
+        """This method is used to determine the rounded values of all points,
+            as 'rounding()' does for a single degree.
+
+        :return: The rounded latitudes and longitudes.
+        :rtype: an N x 2 numpy array"""
+
+        if difference not in self._grids:
+            self.grids([difference])
+        return self._grids[difference]
+
+    def grids(self, differences):
+        """This method is used to determine the rounded values of all points
+            in several degree differences in one pass.
+
+        :param differences: The degree differences, e.g. [0.0001, 0.01].
+        :type differences: list of float
+
+        :return: The rounded values keyed by the degree differences.
+        :rtype: dict"""
+
+        differences = list(differences)
+        indexes = np.rint(self.array[None, :, :] / np.asarray(differences)[:, None, None])
+        for difference, grid_indexes in zip(differences, indexes):
+            decimal_place = _decimal_place(difference)
+            if decimal_place is None:
+                self._grids[difference] = grid_indexes * difference
+            else:
+                self._grids[difference] = np.round(grid_indexes * difference, decimal_place)
+        return {difference: self._grids[difference] for difference in differences}
+
+    def cells(self, difference=DEGREE_DIFFERENCE):
+        """This method is used to determine the cell ids of all points, see
+            'cell_id()'.
+
+        :rtype: numpy array"""
+
+        if difference not in self._cells:
+            self._cells[difference] = cell_ids(self.latitudes, self.longitudes, difference)
+        return self._cells[difference]
+
 class TrafficAccidentData():
+    __slots__ = ("data", "id", "number", "total_fatality", "total_injury",
+                 "pedestrian_fatality", "pedestrian_injury")
+
     def __init__(self, latitude, longitude):
-        controller = TrafficAccidentSQLController()
-        self.data = controller.select_from_coordinate(latitude, longitude)
+        with traffic_accident_source() as controller:
+            self.data = controller.select_from_coordinate(latitude, longitude)
         self.id = None
         self.number = None
         self.total_fatality = None
@@ -100,24 +275,22 @@ class TrafficAccidentData():
             self.pedestrian_injury = self.data[7]
 
 class EarthquakeData():
+    __slots__ = ("latitude", "longitude", "data", "id", "date", "time", "magnitude", "depth")
+
     def __init__(self, latitude, longitude):
         self.latitude = rounding(latitude, difference=0.01)
         self.longitude = rounding(longitude, difference=0.01)
-        controller = EarthquakeSQLController()
-        self.data = controller.select_from_coordinate(self.latitude, self.longitude)
-
-        self.id = []
-        self.date = []
-        self.time = []
-        self.magnitude = []
-        self.depth = []
-        if self.data:
-            for data in self.data:
-                self.id.append(data[0])
-                self.date.append(data[1])
-                self.time.append(data[2])
-                self.magnitude.append(data[5])
-                self.depth.append(data[6])
+        with EarthquakeSQLController() as controller:
+            self.data = controller.select_from_coordinate(self.latitude, self.longitude)
+
+        # Tuples, since an empty tuple is shared rather than allocated for
+        # every point without any earthquake
+        rows = self.data or ()
+        self.id = tuple(data[0] for data in rows)
+        self.date = tuple(data[1] for data in rows)
+        self.time = tuple(data[2] for data in rows)
+        self.magnitude = tuple(data[5] for data in rows)
+        self.depth = tuple(data[6] for data in rows)
 
 def check_if_month_is_valid(month):
     if month is not None:
@@ -139,6 +312,208 @@ def strip_area_2(string):
         string = string[:3]
     return string
 
+# Whether the frames parsed from csv files are kept next to them, see
+# 'cached_csv()'
+CSV_CACHE = os.getenv("CSV_CACHE", "true").lower() == "true"
+CSV_CACHE_SUFFIX = ".cache.npz"
+# Codes of the missing values of the text columns in the cache
+_CACHE_NAN = 1
+_CACHE_NONE = 2
+
+def _file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cached_csv(path, parse, key):
+    """This method is used to get the frame 'parse()' makes out of a csv file
+        from a cache next to the file, e.g. 'Taiwan_food.csv.cache.npz', so
+        that the file is only parsed again after it has changed.
+
+    The cache is used while the file has the same size and modification time
+    as when it was written, or else the same SHA-1 hash, e.g. after the file
+    has been copied. Each column is kept as a plain numpy array, so that the
+    cache is read without pickle. A frame with other values than numbers,
+    texts, flags and missing values is not cached at all.
+
+    :param path: The path of the csv file.
+    :type path: str
+
+    :param parse: The function which reads the file into a frame.
+    :type parse: callable without arguments
+
+    :param key: The name of 'parse', which is to be changed whenever it makes
+        another frame out of the same file, e.g. "car_accident:1".
+    :type key: str
+
+    :rtype: pandas DataFrame"""
+
+    if not CSV_CACHE:
+        return parse()
+    cache_path = f"{path}{CSV_CACHE_SUFFIX}"
+    stat = os.stat(path)
+    sha1 = None
+    try:
+        with np.load(cache_path) as cache:
+            meta = json.loads(str(cache["meta"]))
+            if meta["key"] == key and meta["size"] == stat.st_size:
+                if meta["mtime_ns"] != stat.st_mtime_ns:
+                    sha1 = _file_sha1(path)
+                if sha1 is None or sha1 == meta["sha1"]:
+                    frame = _frame_from_cache(meta, cache)
+                    if sha1 is not None:
+                        # Skip the hash next time
+                        _write_csv_cache(cache_path, frame, key, stat, sha1)
+                    return frame
+    except (OSError, KeyError, ValueError):
+        # No cache yet, or one written by another version
+        pass
+
+    sha1 = sha1 or _file_sha1(path)
+    frame = parse()
+    _write_csv_cache(cache_path, frame, key, stat, sha1)
+    return frame
+
+def _frame_from_cache(meta, cache):
+    data = {}
+    for number, (column, kind) in enumerate(zip(meta["columns"], meta["kinds"])):
+        values = cache[f"column_{number}"]
+        if kind != "number":
+            missing = cache[f"missing_{number}"]
+            values = values.astype(object)
+            values[missing == _CACHE_NAN] = np.nan
+            values[missing == _CACHE_NONE] = None
+        data[column] = values
+    return pd.DataFrame(data, columns=meta["columns"])
+
+def _write_csv_cache(cache_path, frame, key, stat, sha1):
+    index = frame.index
+    if not isinstance(index, pd.RangeIndex) or index.start != 0 or index.step != 1:
+        return
+    arrays = {}
+    kinds = []
+    for number, (column, values) in enumerate(frame.items()):
+        values = values.to_numpy()
+        if values.dtype.kind in "biuf":
+            arrays[f"column_{number}"] = values
+            kinds.append("number")
+            continue
+        if values.dtype != object:
+            return
+        missing = np.array([_CACHE_NONE if value is None else
+                            _CACHE_NAN if isinstance(value, float) and math.isnan(value) else 0
+                            for value in values], dtype=np.int8)
+        present = values[missing == 0]
+        if all(isinstance(value, str) for value in present):
+            arrays[f"column_{number}"] = np.array(np.where(missing == 0, values, "").tolist(), dtype=str)
+            kinds.append("text")
+        elif all(isinstance(value, (bool, np.bool_)) for value in present):
+            arrays[f"column_{number}"] = np.where(missing == 0, values, False).astype(bool)
+            kinds.append("flag")
+        else:
+            return
+        arrays[f"missing_{number}"] = missing
+    meta = {"key": key, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1,
+            "columns": [str(column) for column in frame.columns], "kinds": kinds}
+    # Written aside and moved in place, so that no process reads half of it
+    temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "wb") as file:
+            np.savez(file, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        # e.g. the directory of the file is read only
+        pass
+
+# Number of processes which parse the csv files of a whole year of
+# 'CarAccident' or of 'UpdateTrafficAccidentData(catch_up=True)'
+CSV_PROCESS_NUMBER = int(os.getenv("CSV_PROCESS_NUMBER", os.cpu_count() or 1))
+
+def _car_accident_paths(year, month, rank):
+    """This method is used to determine the csv files of car accidents, which
+        are a file for each year of A1 and a file for each month of A2."""
+
+    if rank == 1 or rank == '1' or rank == "A1" or rank == "a1":
+        return [(f"./data/accidents/{year}/{year}年度A1交通事故資料.csv", False)]
+    elif rank == 2 or rank == '2' or rank == "A2" or rank == "a2":
+        if not month:
+            return [(f"./data/accidents/{year}/{year}年度A2交通事故資料_{m}.csv", True) for m in range(1, 13)]
+        else:
+            return [(f"./data/accidents/{year}/{year}年度A2交通事故資料_{month}.csv", True)]
+    else:
+        message = "Invalid rank. Must be either 1, '1', 'A1', 'a1', or 2, '2', 'A2', 'a2'."
+        raise InvalidRangeError(message)
+
+def _parse_car_accident_csv(path, typed=True):
+    """This method is used to read a csv file of car accidents into only the
+        columns 'CarAccident' uses, with the dates, times, casualties and
+        areas already parsed, so that a worker process sends back a compact
+        frame instead of the whole file. The frame is cached by
+        'cached_csv()'.
+
+    :param typed: Whether to read the columns by their types, which the files
+        of A2 need and those of A1 do not.
+    :type typed: bool"""
+
+    return cached_csv(path, functools.partial(_read_car_accident_csv, path, typed), "car_accident:1")
+
+def _read_car_accident_csv(path, typed):
+
+    dtype_mapping = {
+        "發生日期": str,
+        "發生時間": str,
+        "經度": float,
+        "緯度": float,
+        "死亡受傷人數": str,
+        "發生地點": str,
+        "事故類型": str
+    }
+    if typed:
+        df = pd.read_csv(path, dtype=dtype_mapping, low_memory=False)
+    else:
+        df = pd.read_csv(path)
+    df = df[:-2]
+    casualties = df["死亡受傷人數"]
+    location = df["發生地點"]
+    return pd.DataFrame({
+        "date": [datetime.strptime(str(int(d)), "%Y%m%d").strftime("%Y-%m-%d") for d in df["發生日期"]],
+        "time": [datetime.strptime(str(int(t)).zfill(6), "%H%M%S").strftime("%H:%M:%S") for t in df["發生時間"]],
+        "latitude": df["緯度"].to_numpy(),
+        "longitude": df["經度"].to_numpy(),
+        "fatality": [int(c[2]) for c in casualties],
+        "injury": [int(c[-1]) for c in casualties],
+        "area_1": [loc[:3] for loc in location],
+        # Check if the third character of the string is not one of "鄉", "鎮", "市", or "區"
+        "area_2": [strip_area_2(loc[3:7]) for loc in location],
+        "includes_pedestrian": df["事故類型及型態大類別名稱"].str.contains('人').to_numpy(),
+    })
+
+def _parse_car_accident_csvs(paths):
+    """This method is used to parse several csv files of car accidents in a
+        pool of 'CSV_PROCESS_NUMBER' processes, since it is bound by the CPU,
+        and to concatenate them once at the end in their order.
+
+    :param paths: The paths and whether they are typed, see
+        '_parse_car_accident_csv()'.
+    :type paths: list of tuples"""
+
+    process_number = min(CSV_PROCESS_NUMBER, len(paths))
+    if process_number > 1:
+        with concurrent.futures.ProcessPoolExecutor(process_number) as executor:
+            frames = list(executor.map(_parse_car_accident_csv, *zip(*paths)))
+    else:
+        frames = [_parse_car_accident_csv(path, typed) for path, typed in paths]
+    return pd.concat(frames, ignore_index=True)
+
+def _car_accident_data(year, month, rank):
+    # The deduplicated accidents of a single step of 'UpdateTrafficAccidentData',
+    # which is run in a worker process of the catch-up mode
+    data = CarAccident(year=year, month=month, rank=rank).data
+    data.insert(0, "rank", rank)
+    return data
+
 class CarAccident:
     def __init__(self, year, month=None, rank=2):
         """This class is used to get data from car accident csv files.
@@ -177,59 +552,20 @@ class CarAccident:
     def _read_csv_file(self):
         """This method is used to read and get data from the csv files."""
 
-        dtype_mapping = {
-            "發生日期": str,
-            "發生時間": str,
-            "經度": float,
-            "緯度": float,
-            "死亡受傷人數": str,
-            "發生地點": str,
-            "事故類型": str
-        }
-        if self._rank == 1 or self._rank == '1' or self._rank == "A1" or self._rank == "a1":
-            path = f"./data/accidents/{self._year}/{self._year}年度A1交通事故資料.csv"
-            self._df = pd.read_csv(path)
-            self._df = self._df[:-2]
-            # if self._month:
-            #     self._df['發生日期'] = self._df['發生日期'].astype(int)
-            #     if self._month > 9:
-            #         self._df = self._df[self._df['發生日期'].astype(str).str[4:6] == str(self._month)]
-            #     else:
-            #         self._df = self._df[self._df['發生日期'].astype(str).str[4:6] == f"0{self._month}"]
-            #     self._df['發生日期'] = self._df['發生日期'].astype(float)
-            #     self._df = self._df.reset_index(drop=True)
-        elif self._rank == 2 or self._rank == '2' or self._rank == "A2" or self._rank == "a2":
-            if not self._month:
-                for m in range(1, 13):
-                    path = f"./data/accidents/{self._year}/{self._year}年度A2交通事故資料_{m}.csv"
-                    monthly_data = pd.read_csv(path, dtype=dtype_mapping, low_memory=False)
-                    monthly_data = monthly_data[:-2]
-                    self._df = pd.concat([self._df, monthly_data], ignore_index=True)
-            else:
-                path = f"./data/accidents/{self._year}/{self._year}年度A2交通事故資料_{self._month}.csv"
-                self._df = pd.read_csv(path, dtype=dtype_mapping, low_memory=False)
-                self._df = self._df[:-2]
-        else:
-            message = "Invalid rank. Must be either 1, '1', 'A1', 'a1', or 2, '2', 'A2', 'a2'."
-            raise InvalidRangeError(message)
+        self._df = _parse_car_accident_csvs(_car_accident_paths(self._year, self._month, self._rank))
 
     def _get_data(self):
         """This method is used to take the data of interest"""
 
-        self._dates = [datetime.strptime(str(int(d)), "%Y%m%d").strftime("%Y-%m-%d") for d in self._df["發生日期"]]
-        self._times = [datetime.strptime(str(int(t)).zfill(6), "%H%M%S").strftime("%H:%M:%S") for t in self._df["發生時間"]]
-        self._latitudes = self._df["緯度"]
-        self._longitudes = self._df["經度"]
-        self._casualties = self._df["死亡受傷人數"]
-        self._fatalities = [int(c[2]) for c in self._casualties]
-        self._injuries = [int(c[-1]) for c in self._casualties]
-        self._location = self._df["發生地點"]
-        self._area_1 = [loc[:3] for loc in self._location]
-        self._area_2 = [loc[3:7] for loc in self._location]
-        # Check if the third character of the string is not one of "鄉", "鎮", "市", or "區"
-        for i in range(len(self._area_2)):
-            self._area_2[i] =  strip_area_2(self._area_2[i])
-        self._includes_pedestrian = self._df["事故類型及型態大類別名稱"].str.contains('人')
+        self._dates = self._df["date"].tolist()
+        self._times = self._df["time"].tolist()
+        self._latitudes = self._df["latitude"]
+        self._longitudes = self._df["longitude"]
+        self._fatalities = self._df["fatality"].tolist()
+        self._injuries = self._df["injury"].tolist()
+        self._area_1 = self._df["area_1"].tolist()
+        self._area_2 = self._df["area_2"].tolist()
+        self._includes_pedestrian = self._df["includes_pedestrian"]
 
         self._reorganize_data()
 
@@ -387,7 +723,9 @@ class Earthquake:
             "城市": str,
             "震度": str
         }
-        self._df = pd.read_csv(path, engine='python', encoding="big5", dtype=dtype_mapping)
+        self._df = cached_csv(path, functools.partial(pd.read_csv, path, engine='python',
+                                                      encoding="big5", dtype=dtype_mapping),
+                              "earthquake:1")
 
     def _get_data(self):
         self._dates = [datetime.strptime(d, "%Y-%m-%d") for d in self._df["Date"]]
@@ -473,8 +811,21 @@ class Attraction:
     def __init__(self, index=1):
         self._index = index
         self._df = pd.DataFrame()
+        # The geocoding of '_reorganize_data()' is cached as well
+        self.data = cached_csv(self._path(), self._parse_csv_file, "attraction:1")
+        self._take_data()
+
+    def _path(self):
+        if self._index == 1 or self._index == 2 or self._index == 3:
+            return f"./data/hotspots/Taiwan_attractions_{self._index}.csv"
+        else:
+            message = "Invalid index. Must be either 1, 2, or 3."
+            raise InvalidRangeError(message)
+
+    def _parse_csv_file(self):
         self._read_csv_file()
         self._get_data()
+        return self.data
 
     def _read_csv_file(self):
         """This method is used to read and get data from the csv files."""
@@ -488,12 +839,7 @@ class Attraction:
             "area_2": str,
             "image": str
         }
-        if self._index == 1 or self._index == 2 or self._index == 3:
-            path = f"./data/hotspots/Taiwan_attractions_{self._index}.csv"
-            self._df = pd.read_csv(path, dtype=dtype_mapping, low_memory=False)
-        else:
-            message = "Invalid index. Must be either 1, 2, or 3."
-            raise InvalidRangeError(message)
+        self._df = pd.read_csv(self._path(), dtype=dtype_mapping, low_memory=False)
 
     def _get_data(self):
         """This method is used to take the data of interest"""
@@ -569,6 +915,8 @@ class Attraction:
             "address",
             "image",
         ])
+
+    def _take_data(self):
         self._names = self.data.iloc[:, 0]
         self._latitudes = self.data.iloc[:, 1]
         self._longitudes = self.data.iloc[:, 2]
@@ -621,10 +969,17 @@ class Attraction:
             return self._images
 
 class Restaurant:
+    PATH = "./data/restaurants/Taiwan_food.csv"
+
     def __init__(self):
         self._df = pd.DataFrame()
+        self.data = cached_csv(self.PATH, self._parse_csv_file, "restaurant:1")
+        self._take_data()
+
+    def _parse_csv_file(self):
         self._read_csv_file()
         self._get_data()
+        return self.data
 
     def _read_csv_file(self):
         """This method is used to read and get data from the csv files."""
@@ -642,8 +997,7 @@ class Restaurant:
             "avg_price": int,
             "image": str
         }
-        path = "./data/restaurants/Taiwan_food.csv"
-        self._df = pd.read_csv(path, dtype=dtype_mapping, low_memory=False)
+        self._df = pd.read_csv(self.PATH, dtype=dtype_mapping, low_memory=False)
 
     def _get_data(self):
         """This method is used to take the data of interest"""
@@ -704,6 +1058,8 @@ class Restaurant:
             "avg_price",
             "image",
         ])
+
+    def _take_data(self):
         self._names = self.data.iloc[:, 0]
         self._latitudes = self.data.iloc[:, 1]
         self._longitudes = self.data.iloc[:, 2]
@@ -787,19 +1143,254 @@ class Restaurant:
 ### SQLController ###
 from pathlib import Path
 
+# The largest number of connections kept open to each database file
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 8))
+# Seconds to wait for a connection when all of them are borrowed
+SQLITE_POOL_TIMEOUT = float(os.getenv("SQLITE_POOL_TIMEOUT", 30))
+
+class ConnectionPool:
+    """This class is used to share a bounded number of sqlite3 connections to
+        a database file between all the SQL controllers of a process.
+
+    Controllers borrow a connection with 'acquire()' and give it back with
+    'release()', which rolls back anything left uncommitted. Connections are
+    only opened when no idle one is left and never more than 'size' of
+    them; beyond that 'acquire()' waits for one to be released.
+
+    :param path: The path of the sqlite3 database file.
+    :type path: str
+
+    :param size: The largest number of open connections.
+    :type size: int
+
+    :param timeout: Seconds to wait for a connection before giving up.
+    :type timeout: float"""
+
+    def __init__(self, path, size=SQLITE_POOL_SIZE, timeout=SQLITE_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                # Connections are handed between threads, but only one thread
+                # uses a connection at a time
+                return sqlite3.connect(self.path, check_same_thread=False)
+            except sqlite3.Error:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            message = f"No connection to '{self.path}' was released within {self.timeout} seconds."
+            raise sqlite3.OperationalError(message)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        """This method is used to close the idle connections. Borrowed
+            connections are kept open until they are released."""
+
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(path=None):
+    """This method is used to get the connection pool of a database file,
+        which is 'SQLController.PATH' by default."""
+
+    path = path or SQLController.PATH
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+def close_connection_pools():
+    """This method is used to close the idle connections of every pool, e.g.
+        when a worker process exits."""
+
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+def _forget_connection_pools():
+    # sqlite3 connections must not be used across fork(), so a forked worker
+    # starts with empty pools instead of the ones of its parent
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+atexit.register(close_connection_pools)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_connection_pools)
+
+# Number of threads shared by the route lookups of a process, by default one
+# for each connection of the pool so that no thread waits for a connection
+ROUTE_EXECUTOR_SIZE = int(os.getenv("ROUTE_EXECUTOR_SIZE", SQLITE_POOL_SIZE))
+# Number of tasks a single request may have in the executor at once
+ROUTE_FAN_OUT = int(os.getenv("ROUTE_FAN_OUT", 2))
+
+class RouteExecutor(concurrent.futures.ThreadPoolExecutor):
+    """This class is a thread pool of a fixed size shared by every request of
+        a process, so that a burst of requests queues up for the database
+        instead of starting a thread each.
+
+    It counts the tasks which are queued, running and completed, see
+    'metrics()', which the 'executor_metrics' view serves to staff. Use 'route_executor()' to get the one of the process, and
+    'fan_out()' to limit the tasks of a single request.
+
+    :param size: The number of threads.
+    :type size: int"""
+
+    def __init__(self, size=ROUTE_EXECUTOR_SIZE):
+        super().__init__(max_workers=size, thread_name_prefix="route")
+        self.size = size
+        self._metrics_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._metrics_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        try:
+            return super().submit(self._run, fn, args, kwargs)
+        except BaseException:
+            with self._metrics_lock:
+                self.queued -= 1
+            raise
+
+    def _run(self, fn, args, kwargs):
+        with self._metrics_lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._metrics_lock:
+                self.running -= 1
+                self.completed += 1
+
+    def metrics(self):
+        """This method is used to get the numbers of threads and of tasks,
+            where 'queued' is the depth of the queue and 'max_queued' the
+            deepest it has been.
+
+        :rtype: dict"""
+
+        with self._metrics_lock:
+            return {"size": self.size, "queued": self.queued, "running": self.running,
+                    "completed": self.completed, "max_queued": self.max_queued}
+
+    def fan_out(self, limit=ROUTE_FAN_OUT):
+        """This method is used to get an object with the same 'submit()'
+            which blocks while a request already has 'limit' tasks in the
+            executor, so that one long route cannot take all of the threads.
+
+        Tasks submitted through it must not submit tasks of their own to the
+        executor and wait for them, since every thread may be waiting."""
+
+        return _FanOut(self, limit)
+
+class _FanOut:
+    def __init__(self, executor, limit):
+        self._executor = executor
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def submit(self, fn, /, *args, **kwargs):
+        self._semaphore.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return future
+
+_route_executor = None
+_route_executor_lock = threading.Lock()
+
+def route_executor():
+    """This method is used to get the 'RouteExecutor' of the process."""
+
+    global _route_executor
+    with _route_executor_lock:
+        if _route_executor is None:
+            _route_executor = RouteExecutor()
+        return _route_executor
+
+def _forget_route_executor():
+    # Threads do not survive fork(), so a forked worker starts its own
+    global _route_executor, _route_executor_lock
+    _route_executor = None
+    _route_executor_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_route_executor)
+
 class SQLController:
-    """This class is used to control 'db.sqlites' by using sqlite3 module."""
+    """This class is used to control 'db.sqlites' by using sqlite3 module.
+
+    The connection is borrowed from 'connection_pool()' and given back by
+    'close()', or at the end of a 'with' block."""
 
     # PATH = r"..\.\db.sqlite3"
     BASE_DIR = Path(__file__).resolve().parent.parent
     PATH = os.getenv('DATABASE_PATH', os.path.join(BASE_DIR, "db.sqlite3"))
+    # SQLite's default limit of host parameters in a single statement
+    MAX_VARIABLE_NUMBER = 999
+
     def __init__(self, table_name):
         self.table_name = table_name
-        self.conn = sqlite3.connect(SQLController.PATH)
+        self._pool = connection_pool()
+        self.conn = self._pool.acquire()
         self.cursor = self.conn.cursor()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Give back the connection of a controller which was never closed
+        try:
+            self.close()
+        except Exception:
+            pass
+
     def close(self):
-        self.conn.close()
+        if getattr(self, "conn", None) is not None:
+            self.cursor.close()
+            self._pool.release(self.conn)
+            self.conn = None
 
     def select(self, id=None, column=None):
         if id:
@@ -829,6 +1420,31 @@ class SQLController:
         else:
             return None
 
+    def select_from_coordinates(self, coordinates):
+        """This method is used to get data from a whole set of coordinates on
+            the same connection instead of calling 'select_from_coordinate'
+            once for each of them. The coordinates are sent as chunks of a
+            parameterized 'IN' clause, so a route costs a handful of
+            statements no matter how many grid cells it crosses.
+
+        :param coordinates: The rounded (latitude, longitude) values.
+        :type coordinates: iterable of tuples
+
+        :return: The rows found in any of the coordinates.
+        :rtype: list"""
+
+        coordinates = list(set(coordinates))
+        size = SQLController.MAX_VARIABLE_NUMBER // 2
+        data = []
+        for index in range(0, len(coordinates), size):
+            chunk = coordinates[index: index + size]
+            values = ", ".join(["(?, ?)"] * len(chunk))
+            sql = f"""SELECT * FROM {self.table_name}
+                    WHERE (latitude, longitude) IN (VALUES {values})"""
+            self.cursor.execute(sql, [degree for coordinate in chunk for degree in coordinate])
+            data += self.cursor.fetchall()
+        return data
+
     def select_by_order(self, ordered_column, is_ascending=True):
         sql = f"SELECT * FROM {self.table_name} ORDER BY {ordered_column}"
         if not is_ascending:
@@ -867,13 +1483,67 @@ class SQLController:
         else:
             return None
 
-class TrafficAccidentSQLController(SQLController):
+class GridSQLController(SQLController):
+    """This class is used to control tables whose rows are located by the
+        integer 'cell_id' column (see 'cell_id()') instead of comparing the
+        float values of latitudes and longitudes."""
+
+    # The degree difference of the grid cells stored in 'cell_id'
+    GRID_DIFFERENCE = DEGREE_DIFFERENCE
+
+    def cell_id(self, latitude, longitude):
+        return cell_id(latitude, longitude, self.GRID_DIFFERENCE)
+
+    def select_from_coordinate(self, latitude, longitude):
+        data = self.select_from_cells([self.cell_id(latitude, longitude)])
+        if data:
+            return data
+        else:
+            return None
+
+    def select_from_coordinates(self, coordinates):
+        return self.select_from_cells(CoordinateArray(coordinates).cells(self.GRID_DIFFERENCE).tolist())
+
+    def select_from_cells(self, cells):
+        """This method is used to get data from a whole set of grid cells in
+            chunks of a parameterized 'IN' clause over the indexed 'cell_id'
+            column.
+
+        :param cells: The cell ids determined by 'cell_id()'.
+        :type cells: iterable of int
+
+        :return: The rows found in any of the cells.
+        :rtype: list"""
+
+        cells = list(set(cells))
+        size = SQLController.MAX_VARIABLE_NUMBER
+        data = []
+        for index in range(0, len(cells), size):
+            chunk = cells[index: index + size]
+            values = ", ".join(["?"] * len(chunk))
+            sql = f"SELECT * FROM {self.table_name} WHERE cell_id IN ({values})"
+            self.cursor.execute(sql, chunk)
+            data += self.cursor.fetchall()
+        return data
+
+# The totals of 'risk_traffic_accident' over a set of grid cells, where
+# 'cell_number' is the number of cells with any accident
+TrafficAccidentTotal = collections.namedtuple("TrafficAccidentTotal", [
+    "cell_number", "number", "total_fatality", "total_injury",
+    "pedestrian_fatality", "pedestrian_injury"])
+
+class TrafficAccidentSQLController(GridSQLController):
+    # The columns of the rows of 'risk_traffic_accident' in their order
+    COLUMNS = ("id", "latitude", "longitude", "number", "total_fatality", "total_injury",
+               "pedestrian_fatality", "pedestrian_injury", "cell_id")
+
     def __init__(self):
         self.table_name = "risk_traffic_accident"
         super().__init__(self.table_name)
 
     def new(self, latitude, longitude, fatality, injury, includes_pedestrian):
         coordinate = Coordinate(latitude, longitude)
+        cell = self.cell_id(coordinate.latitude_grid, coordinate.longitude_grid)
         self.existing_id = self.coordinate_id(coordinate.latitude_grid,
                                               coordinate.longitude_grid)
         total_fatality = fatality
@@ -901,23 +1571,189 @@ class TrafficAccidentSQLController(SQLController):
         else:
             sql = f"""INSERT INTO {self.table_name} (latitude, longitude, number,
                         total_fatality, total_injury, pedestrian_fatality,
-                        pedestrian_injury) VALUES (?, ?, ?, ?, ?, ?, ?)"""
+                        pedestrian_injury, cell_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
             self.cursor.execute(sql, (coordinate.latitude_grid,
                                       coordinate.longitude_grid,
                                       1, total_fatality, total_injury,
-                                      pedestrian_fatality, pedestrian_injury))
+                                      pedestrian_fatality, pedestrian_injury,
+                                      cell))
         self.conn.commit()
 
+    def aggregate_from_cells(self, cells):
+        """This method is used to add up the accidents of a whole set of grid
+            cells in the database, so that a single row of totals is fetched
+            instead of a row per cell. The cell ids are sent as one JSON array,
+            so it is a single statement however many cells there are.
+
+        :param cells: The cell ids determined by 'cell_id()'.
+        :type cells: iterable of int
+
+        :rtype: TrafficAccidentTotal"""
+
+        cells = json.dumps(sorted({int(cell) for cell in cells}))
+        sql = f"""SELECT COUNT(*), SUM(number), SUM(total_fatality), SUM(total_injury),
+                         SUM(pedestrian_fatality), SUM(pedestrian_injury)
+                  FROM {self.table_name}
+                  WHERE cell_id IN (SELECT value FROM json_each(?))"""
+        self.cursor.execute(sql, (cells,))
+        # SUM() of no rows is NULL
+        return TrafficAccidentTotal(*(value or 0 for value in self.cursor.fetchone()))
+
     def coordinate_id(self, latitude, longitude):
-        sql = f"""SELECT * FROM {self.table_name}
-                    WHERE latitude = {latitude} AND longitude = {longitude}"""
-        self.cursor.execute(sql)
+        sql = f"SELECT id FROM {self.table_name} WHERE cell_id = ?"
+        self.cursor.execute(sql, (self.cell_id(latitude, longitude),))
         data = self.cursor.fetchone()
         if data:
             return data[0]
         else:
             return None
 
+class TrafficAccidentIndex:
+    """This class is used to keep the whole 'risk_traffic_accident' table in
+        memory as a dictionary from grid cell ids to table rows, so that
+        looking up a route does not touch the database at all.
+
+    The index is built once per process and remembers the version of the
+    risk data it was built from, see 'database_generation()'.
+    'TrafficAccidentIndex.get()' builds a new one when the risk data has
+    been written since, e.g. by 'UpdateTrafficAccidentData', which it checks
+    at most every 'DATABASE_GENERATION_TTL' seconds.
+
+    It has the same lookup methods as 'TrafficAccidentSQLController', so
+    either of them can be returned by 'traffic_accident_source()'."""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.generation = None
+        self._cells = {}
+        self.reload()
+
+    @classmethod
+    def get(cls):
+        # The version is compared without the lock, so lookups only wait for
+        # each other while a new index is built and swapped in. The version
+        # only goes up, so an index built from newer data is kept
+        generation = recent_database_generation()
+        instance = cls._instance
+        if instance is not None and instance.generation >= generation:
+            return instance
+        with cls._lock:
+            if cls._instance is None or cls._instance.generation < generation:
+                cls._instance = cls()
+            return cls._instance
+
+    def reload(self):
+        generation = database_generation()
+        columns = TrafficAccidentSQLController.COLUMNS
+        with TrafficAccidentSQLController() as controller:
+            controller.cursor.execute(f"SELECT {', '.join(columns)} FROM {controller.table_name}")
+            rows = controller.cursor.fetchall()
+        cell = columns.index("cell_id")
+        self._cells = {row[cell]: row for row in rows}
+        self.generation = generation
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def select_from_coordinate(self, latitude, longitude):
+        data = self._cells.get(cell_id(latitude, longitude))
+        if data:
+            return [data]
+        else:
+            return None
+
+    def select_from_coordinates(self, coordinates):
+        return self.select_from_cells(CoordinateArray(coordinates).cells().tolist())
+
+    def select_from_cells(self, cells):
+        data = []
+        for cell in set(cells):
+            row = self._cells.get(cell)
+            if row:
+                data.append(row)
+        return data
+
+    def aggregate_from_cells(self, cells):
+        rows = self.select_from_cells(cells)
+        # The columns from 'number' to 'pedestrian_injury'
+        return TrafficAccidentTotal(len(rows), *(sum(row[column] for row in rows) for column in range(3, 8)))
+
+def traffic_accident_source():
+    """This method is used to get the object which 'risk_traffic_accident'
+        lookups go through, based on 'TRAFFIC_ACCIDENT_SOURCE'. Call 'close()'
+        on it when finished."""
+
+    if TRAFFIC_ACCIDENT_SOURCE == "memory":
+        return TrafficAccidentIndex.get()
+    if TRAFFIC_ACCIDENT_SOURCE == "raster":
+        # Avoid circular import from raster.py
+        from explorer.raster import TrafficAccidentRaster
+        return TrafficAccidentRaster.get()
+    return TrafficAccidentSQLController()
+
+def database_generation():
+    """This method is used to determine the version of the risk data, i.e.
+        the single row of 'risk_data_version', which is raised by
+        'bump_database_generation()' whenever 'Update*Data' has written risk
+        data. It is the same in every process and does not change on other
+        writes to the database, e.g. of sessions."""
+
+    with SQLController("risk_data_version") as controller:
+        controller.cursor.execute("SELECT version FROM risk_data_version WHERE id = 1")
+        data = controller.cursor.fetchone()
+    if data:
+        return data[0]
+    else:
+        return 0
+
+# How long 'recent_database_generation()' trusts the version it has read, in
+# seconds, so that the in-memory indexes do not query it on every lookup
+DATABASE_GENERATION_TTL = float(os.getenv("DATABASE_GENERATION_TTL", 5))
+# The time and the result of the last query of 'recent_database_generation()'
+_recent_generation = (-math.inf, 0)
+
+def recent_database_generation():
+    """This method is used to determine the version of the risk data like
+        'database_generation()', but queries it at most once every
+        'DATABASE_GENERATION_TTL' seconds per process, so that it can be
+        checked on every lookup of an in-memory index.
+
+    Writes of another process are therefore seen up to
+    'DATABASE_GENERATION_TTL' seconds late, and those of this process at
+    once, see 'bump_database_generation()'."""
+
+    global _recent_generation
+    checked_at, generation = _recent_generation
+    now = time.monotonic()
+    if now - checked_at >= DATABASE_GENERATION_TTL:
+        generation = database_generation()
+        # A single assignment of a tuple, so no lock is needed
+        _recent_generation = (now, generation)
+    return generation
+
+def bump_database_generation():
+    global _recent_generation
+    with SQLController("risk_data_version") as controller:
+        with controller.conn:
+            controller.cursor.execute("""INSERT INTO risk_data_version (id, version) VALUES (1, 1)
+                                         ON CONFLICT(id) DO UPDATE SET version = version + 1""")
+    _recent_generation = (-math.inf, 0)
+
+def load_indexes():
+    """This method is used to build the in-memory indexes at worker start so
+        that the first request does not pay for it."""
+
+    if TRAFFIC_ACCIDENT_SOURCE in ("memory", "raster"):
+        traffic_accident_source()
+
 class PedestrianHellSQLController(SQLController):
     def __init__(self):
         self.table_name = "risk_pedestrian_hell"
@@ -965,16 +1801,205 @@ class PedestrianHellSQLController(SQLController):
 
     def administrative_area_id(self, area_1, area_2):
         sql = f"""SELECT * FROM {self.table_name}
-                    WHERE area_1 = '{area_1}'
-                    AND area_2 = '{area_2}'"""
-        self.cursor.execute(sql)
+                    WHERE area_1 = ?
+                    AND area_2 = ?"""
+        self.cursor.execute(sql, (area_1, area_2))
         data = self.cursor.fetchone()
         if data:
             return data[0]
         else:
             return None
 
-class EarthquakeSQLController(SQLController):
+class TrafficAccidentEventSQLController(GridSQLController):
+    """This class is used to control 'risk_traffic_accident_event', which
+        keeps one row for each accident instead of the totals of grid cells
+        and administrative areas.
+
+    The totals in 'risk_traffic_accident' and 'risk_pedestrian_hell' are
+    added up from the accidents inserted by 'new_many()' in the same
+    transaction, so an accident is counted once however often its step is
+    loaded. They can be rebuilt from the table by 'rebuild()', e.g. after the
+    grid size has been changed, as long as the table holds every step they
+    have been added up from."""
+
+    COLUMNS = ("rank", "date", "time", "latitude", "longitude", "cell_id",
+               "area_1", "area_2", "fatality", "injury", "includes_pedestrian")
+
+    def __init__(self):
+        self.table_name = "risk_traffic_accident_event"
+        super().__init__(self.table_name)
+        # The grid is determined by the same Python functions as everywhere
+        # else, so that it does not depend on the rounding of SQLite
+        self.conn.create_function("grid_cell_id", 3, cell_id, deterministic=True)
+        self.conn.create_function("grid_rounding", 2, rounding, deterministic=True)
+
+    def new_many(self, rank, dates, times, latitudes, longitudes, fatalities, injuries,
+                 area_1s, area_2s, includes_pedestrian, totals=True):
+        """This method is used to add a whole batch of accidents and their
+            totals in a single transaction.
+
+        An accident which has already been added, i.e. with the same rank,
+        date, time and coordinate, is skipped. Only the accidents which are
+        actually inserted, i.e. those with an id above the largest one before
+        the batch, are added to 'risk_traffic_accident' and
+        'risk_pedestrian_hell', so loading a step again changes nothing.
+
+        :param rank: The rank of the accidents, see 'CarAccident', or one for
+            each of them.
+        :type rank: int or sequence of int
+        :param totals: Whether to add the accidents to the totals, which is
+            left to 'rebuild()' when the totals already include them.
+        :type totals: bool
+
+        :return: The number of accidents added.
+        :rtype: int"""
+
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        cells = CoordinateArray(np.column_stack([latitudes, longitudes])).cells(self.GRID_DIFFERENCE)
+        columns = [np.broadcast_to(np.asarray(rank, dtype=np.int64), len(cells)).tolist(),
+                   [str(date) for date in dates],
+                   [str(time) for time in times],
+                   latitudes.tolist(),
+                   longitudes.tolist(),
+                   cells.tolist(),
+                   list(area_1s),
+                   list(area_2s),
+                   np.asarray(fatalities, dtype=np.int64).tolist(),
+                   np.asarray(injuries, dtype=np.int64).tolist(),
+                   np.asarray(includes_pedestrian, dtype=bool).tolist()]
+        sql = f"""INSERT OR IGNORE INTO {self.table_name} ({", ".join(self.COLUMNS)})
+                  VALUES ({", ".join(["?"] * len(self.COLUMNS))})"""
+        with self.conn:
+            # The write lock is taken before the largest id is read, so that
+            # no other writer can insert rows in between
+            self.cursor.execute("BEGIN IMMEDIATE")
+            self.cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {self.table_name}")
+            last_id = self.cursor.fetchone()[0]
+            self.cursor.executemany(sql, zip(*columns))
+            self.cursor.execute(f"SELECT COUNT(*) FROM {self.table_name} WHERE id > ?", (last_id,))
+            number = self.cursor.fetchone()[0]
+            if number and totals:
+                self.cursor.execute(f"""INSERT INTO risk_traffic_accident (latitude, longitude, number,
+                                            total_fatality, total_injury, pedestrian_fatality,
+                                            pedestrian_injury, cell_id)
+                                        SELECT grid_rounding(MIN(latitude), :difference),
+                                               grid_rounding(MIN(longitude), :difference),
+                                               COUNT(*), SUM(fatality), SUM(injury),
+                                               SUM(CASE WHEN includes_pedestrian THEN fatality ELSE 0 END),
+                                               SUM(CASE WHEN includes_pedestrian THEN injury ELSE 0 END),
+                                               cell_id
+                                        FROM {self.table_name}
+                                        WHERE id > :last_id
+                                        GROUP BY cell_id
+                                        ON CONFLICT(cell_id) DO UPDATE SET
+                                            number = number + excluded.number,
+                                            total_fatality = total_fatality + excluded.total_fatality,
+                                            total_injury = total_injury + excluded.total_injury,
+                                            pedestrian_fatality = pedestrian_fatality + excluded.pedestrian_fatality,
+                                            pedestrian_injury = pedestrian_injury + excluded.pedestrian_injury""",
+                                    {"difference": self.GRID_DIFFERENCE, "last_id": last_id})
+                self.cursor.execute(f"""INSERT INTO risk_pedestrian_hell (area_1, area_2, number,
+                                            total_fatality, total_injury, pedestrian_fatality,
+                                            pedestrian_injury)
+                                        SELECT area_1, area_2, COUNT(*), SUM(fatality), SUM(injury),
+                                               SUM(CASE WHEN includes_pedestrian THEN fatality ELSE 0 END),
+                                               SUM(CASE WHEN includes_pedestrian THEN injury ELSE 0 END)
+                                        FROM {self.table_name}
+                                        WHERE id > ?
+                                        GROUP BY area_1, area_2
+                                        ON CONFLICT(area_1, area_2) DO UPDATE SET
+                                            number = number + excluded.number,
+                                            total_fatality = total_fatality + excluded.total_fatality,
+                                            total_injury = total_injury + excluded.total_injury,
+                                            pedestrian_fatality = pedestrian_fatality + excluded.pedestrian_fatality,
+                                            pedestrian_injury = pedestrian_injury + excluded.pedestrian_injury""",
+                                    (last_id,))
+        return number
+
+    def missing_steps(self, steps):
+        """This method is used to find the steps of 'UpdateTrafficAccidentData'
+            which have no accident in the table, e.g. because they were added
+            before the table existed.
+
+        :param steps: The (year, month, rank) of the steps, with the year in
+            the Republic of China calendar as in 'CarAccident'.
+        :type steps: iterable of tuples
+
+        :return: The steps without any accident, in the given order.
+        :rtype: list of tuples"""
+
+        # A1 is loaded a year at a time and A2 a month at a time
+        self.cursor.execute(f"""SELECT DISTINCT rank, substr(date, 1, 4), substr(date, 6, 2)
+                                FROM {self.table_name}""")
+        years, months = set(), set()
+        for rank, year, month in self.cursor.fetchall():
+            years.add((rank, int(year)))
+            months.add((rank, int(year), int(month)))
+        missing = []
+        for year, month, rank in steps:
+            if rank == 1:
+                found = (rank, year + 1911) in years
+            else:
+                found = (rank, year + 1911, month) in months
+            if not found:
+                missing.append((year, month, rank))
+        return missing
+
+    def rebuild(self, steps, difference=DEGREE_DIFFERENCE):
+        """This method is used to replace the totals in 'risk_traffic_accident'
+            and 'risk_pedestrian_hell' by those of the accidents in the table,
+            with a 'GROUP BY' for each of them in a single transaction.
+
+        Nothing is deleted if any of the steps the totals have been added up
+        from has no accident in the table, since its accidents would be lost.
+        'RebuildTrafficAccidentData' loads them from the csv files first.
+
+        :param steps: The (year, month, rank) of the steps which have been
+            added to the totals, see 'UpdateTrafficAccidentData.added_steps()'.
+        :type steps: iterable of tuples
+        :param difference: The degree difference of the grid cells of
+            'risk_traffic_accident', which must be the one the lookups use.
+        :type difference: float
+
+        :return: The number of grid cells and of administrative areas.
+        :rtype: a tuple of two int"""
+
+        missing = self.missing_steps(steps)
+        if missing:
+            message = (f"The accidents of {len(missing)} added steps, e.g. {missing[0]}, "
+                       f"are not in '{self.table_name}'. Rebuilding would lose them.")
+            raise InvalidRangeError(message)
+        with self.conn:
+            self.cursor.execute("DELETE FROM risk_traffic_accident")
+            self.cursor.execute(f"""INSERT INTO risk_traffic_accident (latitude, longitude, number,
+                                        total_fatality, total_injury, pedestrian_fatality,
+                                        pedestrian_injury, cell_id)
+                                    SELECT grid_rounding(MIN(latitude), :difference),
+                                           grid_rounding(MIN(longitude), :difference),
+                                           COUNT(*), SUM(fatality), SUM(injury),
+                                           SUM(CASE WHEN includes_pedestrian THEN fatality ELSE 0 END),
+                                           SUM(CASE WHEN includes_pedestrian THEN injury ELSE 0 END),
+                                           grid_cell_id(latitude, longitude, :difference) AS cell
+                                    FROM {self.table_name}
+                                    GROUP BY cell""", {"difference": difference})
+            cell_number = self.cursor.rowcount
+            self.cursor.execute("DELETE FROM risk_pedestrian_hell")
+            self.cursor.execute(f"""INSERT INTO risk_pedestrian_hell (area_1, area_2, number,
+                                        total_fatality, total_injury, pedestrian_fatality,
+                                        pedestrian_injury)
+                                    SELECT area_1, area_2, COUNT(*), SUM(fatality), SUM(injury),
+                                           SUM(CASE WHEN includes_pedestrian THEN fatality ELSE 0 END),
+                                           SUM(CASE WHEN includes_pedestrian THEN injury ELSE 0 END)
+                                    FROM {self.table_name}
+                                    GROUP BY area_1, area_2""")
+            area_number = self.cursor.rowcount
+        bump_database_generation()
+        return cell_number, area_number
+
+class EarthquakeSQLController(GridSQLController):
+    GRID_DIFFERENCE = 0.01
+
     def __init__(self):
         self.table_name = "risk_earthquake"
         super().__init__(self.table_name)
@@ -982,8 +2007,9 @@ class EarthquakeSQLController(SQLController):
     def new(self, date, time, latitude, longitude, magnitude, depth):
         sql = f"""INSERT INTO {self.table_name} (
                 date, time, latitude, longitude,
-                magnitude, depth) VALUES (?, ?, ?, ?, ?, ?)"""
-        self.cursor.execute(sql, (date, str(time), latitude, longitude, magnitude, depth))
+                magnitude, depth, cell_id) VALUES (?, ?, ?, ?, ?, ?, ?)"""
+        self.cursor.execute(sql, (date, str(time), latitude, longitude, magnitude, depth,
+                                  self.cell_id(latitude, longitude)))
         self.conn.commit()
 
 class EarthquakeIntensitySQLController(SQLController):
@@ -1052,10 +2078,21 @@ class RestaurantSQLController(SQLController):
 
 
 class UpdateTrafficAccidentData:
-    def __init__(self):
+    def __init__(self, catch_up=False):
+        """This class is used to add the car accidents of the step after the
+            one in the tracking data, i.e. a year of A1 or a month of A2.
+
+        :param catch_up: Whether to add every step up to the ending year in
+            the tracking data at once instead, with the csv files parsed in a
+            pool of 'CSV_PROCESS_NUMBER' processes.
+        :type catch_up: bool"""
+
         self.get_tracking_data()
-        self.determine_range()
-        self.update_data()
+        if catch_up:
+            self.catch_up()
+        else:
+            self.determine_range()
+            self.update_data()
         self.update_tracking_data()
 
     def get_tracking_data(self):
@@ -1094,23 +2131,95 @@ class UpdateTrafficAccidentData:
         self.accident = CarAccident(year=self.tracking_year,
                                     month=self.tracking_month,
                                     rank=self.tracking_rank)
-        self.traffic_controller = TrafficAccidentSQLController()
-        self.ped_hell_controller = PedestrianHellSQLController()
         self.number_of_data = len(self.accident.data)
-        for i in range(self.number_of_data):
-            latitude = self.accident.latitude(i)
-            longitude = self.accident.longitude(i)
-            fatality = self.accident.fatality(i)
-            injury = self.accident.injury(i)
-            area_1 = self.accident.area_1(i)
-            area_2 = self.accident.area_2(i)
-            includes_pedestrian = self.accident.includes_pedestrian(i)
-            self.traffic_controller.new(latitude, longitude,
-                                        fatality, injury, includes_pedestrian)
-            self.ped_hell_controller.new(area_1, area_2,
-                                         fatality, injury, includes_pedestrian)
-        self.traffic_controller.close()
-        self.ped_hell_controller.close()
+        with TrafficAccidentEventSQLController() as controller:
+            controller.new_many(self.tracking_rank,
+                                self.accident.date(),
+                                self.accident.time(),
+                                self.accident.latitude(),
+                                self.accident.longitude(),
+                                self.accident.fatality(),
+                                self.accident.injury(),
+                                self.accident.area_1(),
+                                self.accident.area_2(),
+                                self.accident.includes_pedestrian())
+        bump_database_generation()
+
+    def pending_steps(self):
+        """This method is used to determine the steps which have not been added
+            yet, up to the ending year in the tracking data.
+
+        :return: The (year, month, rank) of the steps in order.
+        :rtype: list of tuples"""
+
+        tracking = (self.tracking_year, self.tracking_month, self.tracking_rank)
+        steps = []
+        while True:
+            self.determine_range()
+            if self.tracking_year > self.ending_year:
+                break
+            steps.append((self.tracking_year, self.tracking_month, self.tracking_rank))
+        self.tracking_year, self.tracking_month, self.tracking_rank = tracking
+        return steps
+
+    def added_steps(self):
+        """This method is used to determine the steps which have been added
+            according to the tracking data, from the starting year on.
+
+        :return: The (year, month, rank) of the steps in order.
+        :rtype: list of tuples"""
+
+        tracking = (self.tracking_year, self.tracking_month, self.tracking_rank)
+        steps = []
+        if not self.tracking_year:
+            return steps
+        self.tracking_year = self.tracking_month = self.tracking_rank = None
+        while (self.tracking_year, self.tracking_month, self.tracking_rank) != tracking:
+            self.determine_range()
+            if self.tracking_year > tracking[0]:
+                break
+            steps.append((self.tracking_year, self.tracking_month, self.tracking_rank))
+        self.tracking_year, self.tracking_month, self.tracking_rank = tracking
+        return steps
+
+    def load_steps(self, steps, totals=True):
+        """This method is used to add the accidents of a list of steps at once,
+            with the csv files parsed in a pool of 'CSV_PROCESS_NUMBER'
+            processes.
+
+        :param steps: The (year, month, rank) of the steps.
+        :type steps: list of tuples
+        :param totals: Whether to add the accidents to the totals as well,
+            see 'TrafficAccidentEventSQLController.new_many()'.
+        :type totals: bool
+
+        :return: The number of accidents added, i.e. not added before.
+        :rtype: int"""
+
+        if not steps:
+            return 0
+        process_number = min(CSV_PROCESS_NUMBER, len(steps))
+        if process_number > 1:
+            with concurrent.futures.ProcessPoolExecutor(process_number) as executor:
+                frames = list(executor.map(_car_accident_data, *zip(*steps)))
+        else:
+            frames = [_car_accident_data(*step) for step in steps]
+        data = pd.concat(frames, ignore_index=True)
+
+        with TrafficAccidentEventSQLController() as controller:
+            return controller.new_many(data["rank"], data["date"], data["time"],
+                                       data["latitude"], data["longitude"],
+                                       data["fatality"], data["injury"],
+                                       data["area_1"], data["area_2"],
+                                       data["includes_pedestrian"], totals)
+
+    def catch_up(self):
+        steps = self.pending_steps()
+        self.number_of_data = self.load_steps(steps)
+        if not steps:
+            return
+        bump_database_generation()
+        self.tracking_year, self.tracking_month, self.tracking_rank = steps[-1]
 
     def update_tracking_data(self):
         self.tracking_data["sqlite3"]["traffic_accident"]["tracking_year"] = self.tracking_year
@@ -1119,6 +2228,29 @@ class UpdateTrafficAccidentData:
         with open(TRACKING_JSON_PATH, 'w') as file:
             json.dump(self.tracking_data, file)
 
+class RebuildTrafficAccidentData(UpdateTrafficAccidentData):
+    def __init__(self, difference=DEGREE_DIFFERENCE):
+        """This class is used to rebuild 'risk_traffic_accident' and
+            'risk_pedestrian_hell' from 'risk_traffic_accident_event', e.g.
+            after the grid size has been changed.
+
+        The steps in the tracking data whose accidents are not in the event
+        table, e.g. because they were added before it existed, are loaded
+        from the csv files first, so that the totals lose none of them.
+
+        :param difference: The degree difference of the grid cells.
+        :type difference: float"""
+
+        self.get_tracking_data()
+        steps = self.added_steps()
+        with TrafficAccidentEventSQLController() as controller:
+            missing = controller.missing_steps(steps)
+        # The totals of the missing steps are already there, so only their
+        # accidents are loaded, and the totals are replaced below
+        self.number_of_data = self.load_steps(missing, totals=False)
+        with TrafficAccidentEventSQLController() as controller:
+            self.cell_number, self.area_number = controller.rebuild(steps, difference)
+
 class UpdateEarthquakeData:
     def __init__(self):
         self.get_tracking_data()
@@ -1179,6 +2311,7 @@ class UpdateEarthquakeData:
 
         self.earthquake_controller.close()
         self.earthquake_intensity_controller.close()
+        bump_database_generation()
         self.update_tracking_data()
 
     def update_tracking_data(self):
@@ -1239,6 +2372,49 @@ def test_Coordinate():
     # print(coord.traffic_accident.id)
     pass
 
+def test_memory():
+    # Memory allocated by the objects of each point of a route, for the route
+    # of 'DIRECTIONS' and for a synthetic route of 50,000 points. It is
+    # measured with the classes as they are and again with subclasses which
+    # add a '__dict__' back, i.e. as without '__slots__', for comparison
+    import tracemalloc
+    from explorer.maps import DirectionAPI
+    routes = {
+        "DIRECTIONS": DirectionAPI().coordinates,
+        "synthetic": [(25.03 + index * 0.00001, 121.56 + index * 0.00001) for index in range(50000)],
+    }
+    names = ("Coordinate", "TrafficAccidentData", "EarthquakeData")
+    slotted = {name: globals()[name] for name in names}
+    unslotted = {name: type(name, (cls,), {}) for name, cls in slotted.items()}
+    for name, coordinates in routes.items():
+        sizes = {}
+        for layout, classes in (("without __slots__", unslotted), ("with __slots__", slotted)):
+            # 'Coordinate' creates the risk data by their global names
+            globals().update(classes)
+            try:
+                tracemalloc.start()
+                points = []
+                for coordinate in coordinates:
+                    coord = classes["Coordinate"](coordinate)
+                    points.append((coord, coord.traffic_accident, coord.earthquake))
+                sizes[layout] = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                del points
+            finally:
+                globals().update(slotted)
+        print(f"{name}: {len(coordinates)} points")
+        for layout, size in sizes.items():
+            print(f"    {layout}: {size / 1024:.0f} KiB, {size / len(coordinates):.0f} bytes per point")
+    pass
+
+def test_RouteExecutor():
+    executor = RouteExecutor(size=4)
+    fan_out = executor.fan_out(limit=2)
+    futures = [fan_out.submit(threading.Event().wait, 0.1) for _ in range(8)]
+    concurrent.futures.wait(futures)
+    print(executor.metrics())
+    executor.shutdown()
+
 def test_CarAccident():
     accident = CarAccident(year=111, month=2, rank=2)
     # print(accident.date())
@@ -1303,6 +2479,8 @@ def test_Restaurant():
 
 if __name__ == "__main__":
     # test_Coordinate()
+    # test_memory()
+    # test_RouteExecutor()
     # test_CarAccident()
     # test_Attraction()
     # test_TrafficAccident()
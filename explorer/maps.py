@@ -2,21 +2,27 @@ import googlemaps
 import json
 import sys
 import os
-import concurrent.futures
+import numpy as np
 
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 ### runserver
 from explorer.test_data import *
-from explorer.database import Coordinate, PedestrianHellSQLController, AttractionSQLController, RestaurantSQLController
+from explorer.database import CoordinateArray, TrafficAccidentTotal, traffic_accident_source, EarthquakeSQLController, \
+                              PedestrianHellSQLController, AttractionSQLController, RestaurantSQLController, \
+                              DEGREE_DIFFERENCE
+from explorer.route import rasterize, corridor_cells, haversine, EarthquakeIndex, METERS_PER_DEGREE
 import explorer.risk as risk
 
 ### run python file
 # from test_data import *
 # from database import Coordinate, PedestrianHellSQLController
 
-__all__ = ["GOOGLE_MAPS_API_KEY", "Coordinates", "Direction", "Geocode"]
+__all__ = ["GOOGLE_MAPS_API_KEY", "Coordinates", "Direction", "Directions", "Geocode"]
+
+# Default distance in kilometers of '_DirectionEarthquakeData.nearby'
+EARTHQUAKE_RADIUS = 10
 
 
 """
@@ -80,11 +86,8 @@ GOOGLE_MAPS_API_KEY = _get_google_maps_api_key()
 class Coordinates():
     def __init__(self, coordinates):
         self.coordinates = coordinates
-        self.grid = []
-        for coordinate in self.coordinates:
-            coord = Coordinate(coordinate)
-            self.grid.append((coord.latitude_grid, coord.longitude_grid))
-        self.grid = list(set(self.grid))
+        grid = CoordinateArray(coordinates).grid()
+        self.grid = list(set(map(tuple, grid.tolist())))
 
 class DirectionAPI():
     """Get directions between an origin point and a destination point.
@@ -110,18 +113,27 @@ class DirectionAPI():
         returns the direction from '台北101' to '台北市立動物園'. Please
         check 'constants.py' for more information.
     """
-    def __init__(self, origin=None, destination=None, waypoints=None, optimize_waypoints=True):
+    def __init__(self, origin=None, destination=None, waypoints=None, optimize_waypoints=True,
+                 alternatives=False):
         if origin and destination and GOOGLE_MAPS_API_KEY:
             gmaps = googlemaps.Client(key=GOOGLE_MAPS_API_KEY)
-            self.data = gmaps.directions(origin=origin,
-                                         destination=destination,
-                                         waypoints=waypoints,
-                                         optimize_waypoints=optimize_waypoints, )[0]
+            self.routes = gmaps.directions(origin=origin,
+                                           destination=destination,
+                                           waypoints=waypoints,
+                                           optimize_waypoints=optimize_waypoints,
+                                           alternatives=alternatives, )
         else:
-            self.data = DIRECTIONS[0]
+            self.routes = DIRECTIONS
+        if not self.routes:
+            # The status of the Directions API was 'ZERO_RESULTS'
+            raise ValueError("No route was found")
+        self.data = self.routes[0]
         self._coordinates = None
+        self._point_steps = None
         self._traffic_accident = None
         self._earthquake = None
+        self._corridors = {}
+        self._breakdown = None
 
     @property
     def overivew_coordinates(self):
@@ -133,12 +145,29 @@ class DirectionAPI():
     def coordinates(self):
         if self._coordinates is None:
             self._coordinates = []
-            for step in self.data['legs'][0]['steps']:
+            # The index of the step of each point
+            self._point_steps = []
+            for index, step in enumerate(self.data['legs'][0]['steps']):
                 polyline = step['polyline']['points']
                 decoded_polyline = googlemaps.convert.decode_polyline(polyline)
                 self._coordinates += [(point['lat'], point['lng']) for point in decoded_polyline]
+                self._point_steps += [index] * len(decoded_polyline)
         return self._coordinates
 
+    @property
+    def alternative_coordinates(self):
+        """Get the points of every route returned by the Directions API, which
+            are more than one if 'alternatives' is True."""
+
+        alternatives = []
+        for route in self.routes:
+            coordinates = []
+            for step in route['legs'][0]['steps']:
+                decoded_polyline = googlemaps.convert.decode_polyline(step['polyline']['points'])
+                coordinates += [(point['lat'], point['lng']) for point in decoded_polyline]
+            alternatives.append(coordinates)
+        return alternatives
+
     @property
     def instructions(self):
         route_instructions = []
@@ -158,17 +187,86 @@ class DirectionAPI():
             self._earthquake = _DirectionEarthquakeData(self.coordinates)
         return self._earthquake
 
+    def corridor(self, meters):
+        """Get the traffic accidents within a distance of the route instead of
+            only those in the grid cells the route passes.
+
+        :param meters: The width of the corridor on each side of the route.
+        :type meters: float"""
+
+        return _corridor(self, meters)
+
+    def step_risk(self, step_point_numbers=None):
+        """Get the traffic accidents of each step of the route, in the same
+            order as 'instructions'. Every grid cell is counted in the step
+            which passes it first.
+
+        :param step_point_numbers: The number of points of each step, see
+            'Direction.step_risk()', or None for the steps of the route.
+        :type step_point_numbers: list of int or None"""
+
+        if step_point_numbers is None:
+            # 'coordinates' records the step of each point when it is decoded
+            self.coordinates
+            step_point_numbers = np.bincount(self._point_steps, minlength=len(self.data['legs'][0]['steps']))
+        return _step_risk(self, step_point_numbers)
+
+    def segment_risk(self, meters):
+        """Get the traffic accidents of each part of the route of a length of
+            'meters', e.g. to color the route by its risk.
+
+        :param meters: The length of the parts along the route.
+        :type meters: float"""
+
+        if self._breakdown is None:
+            self._breakdown = _DirectionRiskBreakdown(self.coordinates)
+        return self._breakdown.by_distance(meters)
+
+
+def _corridor(direction, meters):
+    # The corridors of 'Direction' and 'DirectionAPI', kept by their widths
+    if meters not in direction._corridors:
+        cells = corridor_cells(direction.coordinates, meters)
+        direction._corridors[meters] = _DirectionTrafficAccidentData.from_cells(cells)
+    return direction._corridors[meters]
+
+def check_step_point_numbers(step_point_numbers, point_number):
+    """This method is used to validate the number of points of each step of a
+        route, see 'step_risk()' of 'Direction' and 'DirectionAPI'.
+
+    :param step_point_numbers: The number of points of each step.
+    :type step_point_numbers: list of int
+
+    :param point_number: The number of points of the route.
+    :type point_number: int
+
+    :return: The numbers of points.
+    :rtype: numpy.ndarray"""
+
+    # bool is a subclass of int, but 'true' is not a number of points
+    if not isinstance(step_point_numbers, (list, tuple, np.ndarray)) or \
+            not all(isinstance(number, (int, np.integer)) and not isinstance(number, bool) and number >= 0
+                    for number in step_point_numbers) or \
+            sum(step_point_numbers) != point_number:
+        raise ValueError("The numbers of points of the steps must add up to the number of points")
+    return np.asarray(step_point_numbers, dtype=np.int64)
+
+def _step_risk(direction, step_point_numbers):
+    # The step risk of 'Direction' and 'DirectionAPI'
+    step_point_numbers = check_step_point_numbers(step_point_numbers, len(direction.coordinates))
+    if direction._breakdown is None:
+        direction._breakdown = _DirectionRiskBreakdown(direction.coordinates)
+    point_steps = np.repeat(np.arange(len(step_point_numbers)), step_point_numbers)
+    return direction._breakdown.by_points(point_steps, len(step_point_numbers))
 
 class Direction():
     def __init__(self, coordinates):
-        self.coordinates = []
-        try:
-            for coordinate in coordinates:
-                self.coordinates.append((coordinate["lat"], coordinate["lng"]))
-        except:
-            self.coordinates = coordinates
+        # The points are validated once and shared by every kind of risk
+        self.coordinates = CoordinateArray(coordinates)
         self._traffic_accident = None
         self._earthquake = None
+        self._corridors = {}
+        self._breakdown = None
 
     @property
     def traffic_accident(self):
@@ -182,227 +280,415 @@ class Direction():
             self._earthquake = _DirectionEarthquakeData(self.coordinates)
         return self._earthquake
 
+    def corridor(self, meters):
+        """Get the traffic accidents within a distance of the route instead of
+            only those in the grid cells the route passes.
+
+        :param meters: The width of the corridor on each side of the route.
+        :type meters: float"""
+
+        return _corridor(self, meters)
+
+    def segment_risk(self, meters):
+        """Get the traffic accidents of each part of the route of a length of
+            'meters', e.g. to color the route by its risk.
+
+        :param meters: The length of the parts along the route.
+        :type meters: float"""
+
+        if self._breakdown is None:
+            self._breakdown = _DirectionRiskBreakdown(self.coordinates)
+        return self._breakdown.by_distance(meters)
+
+    def step_risk(self, step_point_numbers=None):
+        """Get the traffic accidents of each step of the route, where the
+            points of the route are those of its steps one after another, e.g.
+            the 'path' of each step of a route of the Maps JavaScript API.
+            Every grid cell is counted in the step which passes it first.
+
+        :param step_point_numbers: The number of points of each step, or None
+            for the whole route as a single step.
+        :type step_point_numbers: list of int or None"""
+
+        if step_point_numbers is None:
+            step_point_numbers = [len(self.coordinates)]
+        return _step_risk(self, step_point_numbers)
+
+class Directions():
+    """Compare the risk of several routes, e.g. the alternatives of
+        'DirectionAPI', with one lookup of the grid cells of all of them.
+
+    Alternative routes share most of their cells, so the union of their
+    cells is looked up once and the results are attributed back to each
+    route with 'np.isin'.
+
+    :param routes: The points of each route.
+    :type routes: list of lists of tuples or dicts
+    """
+    def __init__(self, routes):
+        self.routes = [CoordinateArray(coordinates) for coordinates in routes]
+        self._traffic_accident_cells = [rasterize(coordinates) for coordinates in self.routes]
+        self._earthquake_cells = [rasterize(coordinates, EarthquakeSQLController.GRID_DIFFERENCE)
+                                  for coordinates in self.routes]
+        self._traffic_accident_union = np.unique(np.concatenate([np.empty(0, dtype=np.int64)]
+                                                                + self._traffic_accident_cells))
+        self._earthquake_union = np.unique(np.concatenate([np.empty(0, dtype=np.int64)]
+                                                          + self._earthquake_cells))
+        self._traffic_accident = None
+        self._earthquake = None
+
+    @property
+    def cell_number(self):
+        # The number of traffic accident cells looked up for all routes
+        return len(self._traffic_accident_union)
+
+    @property
+    def traffic_accident(self):
+        """Get the totals of the traffic accidents of each route.
+
+        :rtype: list of TrafficAccidentTotal"""
+
+        if self._traffic_accident is None:
+            with traffic_accident_source() as controller:
+                data = controller.select_from_cells(self._traffic_accident_union.tolist())
+            data_cells = np.array([row[-1] for row in data], dtype=np.int64)
+            # The columns from 'number' to 'pedestrian_injury'
+            values = np.array([row[3:8] for row in data], dtype=np.int64).reshape(-1, 5)
+            self._traffic_accident = []
+            for route_cells in self._traffic_accident_cells:
+                is_in_route = np.isin(data_cells, route_cells)
+                self._traffic_accident.append(
+                    TrafficAccidentTotal(int(is_in_route.sum()), *values[is_in_route].sum(axis=0).tolist()))
+        return self._traffic_accident
+
+    @property
+    def earthquake(self):
+        """Get the number, the average magnitude and the average depth of the
+            earthquakes of each route, where the averages are None if there
+            is no earthquake.
+
+        :rtype: list of dicts"""
+
+        if self._earthquake is None:
+            with EarthquakeSQLController() as controller:
+                data = controller.select_from_cells(self._earthquake_union.tolist())
+            data_cells = np.array([row[-1] for row in data], dtype=np.int64)
+            magnitudes = np.array([row[5] for row in data], dtype=np.float64)
+            depths = np.array([row[6] for row in data], dtype=np.float64)
+            self._earthquake = []
+            for route_cells in self._earthquake_cells:
+                is_in_route = np.isin(data_cells, route_cells)
+                number = int(is_in_route.sum())
+                if number:
+                    average_magnitude = risk.average_magnitude(magnitudes[is_in_route])
+                    average_depth = float(depths[is_in_route].mean())
+                else:
+                    average_magnitude = average_depth = None
+                self._earthquake.append({"number": number,
+                                         "average_magnitude": average_magnitude,
+                                         "average_depth": average_depth})
+        return self._earthquake
+
 class _DirectionTrafficAccidentData():
     def __init__(self, coordinates):
-        self._coords = []
-        for coordinate in coordinates:
-            self._coords.append(Coordinate(coordinate))
+        # Every grid cell the route passes through, not only those its points
+        # fall in, so long straight steps are fully covered
+        self._cells = rasterize(CoordinateArray(coordinates)).tolist()
         self._data = None
-        self._number = None
-        self._total_fatality = None
-        self._total_injury = None
-        self._pedestrian_fatality = None
-        self._pedestrian_injury = None
+        self._total = None
+
+    @classmethod
+    def from_cells(cls, cells):
+        """Get the data of a set of grid cells determined elsewhere, e.g. by
+            'route.corridor_cells()'."""
+
+        direction_data = cls([])
+        direction_data._cells = np.unique(np.asarray(cells, dtype=np.int64)).tolist()
+        return direction_data
+
+    @property
+    def cells(self):
+        return self._cells
 
     @property
     def data(self):
         if self._data is None:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future_to_coord = {executor.submit(self._get_traffic_data, coord): coord for coord in self._coords}
-                self._data = []
-                for future in concurrent.futures.as_completed(future_to_coord):
-                    data = future.result()
-                    if data:
-                        self._data.append(data)
+            # All grid cells of the route are resolved in one batch
+            with traffic_accident_source() as controller:
+                self._data = controller.select_from_cells(self._cells)
         return self._data
 
-    def _get_traffic_data(self, coord):
-        return coord.traffic_accident.data
+    @property
+    def total(self):
+        """Get the totals of the route, which are added up by the source of
+            the data, so the rows of the cells are never fetched unless
+            'data' is used."""
+
+        if self._total is None:
+            with traffic_accident_source() as controller:
+                self._total = controller.aggregate_from_cells(self._cells)
+        return self._total
 
     @property
     def number(self):
-        if self._number is None:
-            if not self.data:
-                return 0
-            else:
-                self._number = 0
-                for data in self.data:
-                    self._number += data[3]
-        return self._number
+        return self.total.number
 
     @property
     def total_fatality(self):
-        if self._total_fatality is None:
-            if not self.data:
-                return 0
-            else:
-                self._total_fatality = 0
-                for data in self.data:
-                    self._total_fatality += data[4]
-        return self._total_fatality
+        return self.total.total_fatality
 
     @property
     def total_injury(self):
-        if self._total_injury is None:
-            if not self.data:
-                return 0
-            else:
-                self._total_injury = 0
-                for data in self.data:
-                    self._total_injury += data[5]
-        return self._total_injury
+        return self.total.total_injury
 
     @property
     def pedestrian_fatality(self):
-        if self._pedestrian_fatality is None:
-            if not self.data:
-                return None
-            else:
-                self._pedestrian_fatality = 0
-                for data in self.data:
-                    self._pedestrian_fatality += data[6]
-        return self._pedestrian_fatality
+        if self.total.cell_number == 0:
+            return None
+        return self.total.pedestrian_fatality
 
     @property
     def pedestrian_injury(self):
-        if self._pedestrian_injury is None:
-            if not self.data:
-                return None
+        if self.total.cell_number == 0:
+            return None
+        return self.total.pedestrian_injury
+
+# The shortest parts of a route of 'segment_risk()', i.e. a grid cell, and
+# the most parts of a route, so that a request cannot allocate without bound
+MIN_SEGMENT_METERS = DEGREE_DIFFERENCE * METERS_PER_DEGREE
+MAX_SEGMENT_NUMBER = 1000
+
+class _DirectionRiskBreakdown():
+    """This class is used to split the traffic accidents of a route into
+        parts of it, e.g. its steps, with a single lookup of its cells.
+
+    Each cell is tagged with its position along the route when the route is
+    rasterized, and the values of all cells are added up per part in one
+    grouped sum."""
+
+    # The columns of the totals of each part
+    COLUMNS = TrafficAccidentTotal._fields[1:]
+
+    def __init__(self, coordinates):
+        self._coordinates = CoordinateArray(coordinates)
+        self._cells, self._positions = rasterize(self._coordinates, return_positions=True)
+        self._values = None
+        self._distances = None
+
+    @property
+    def values(self):
+        """The values of 'COLUMNS' of each cell, zero where no accident has
+            happened."""
+
+        if self._values is None:
+            with traffic_accident_source() as controller:
+                data = controller.select_from_cells(self._cells.tolist())
+            self._values = np.zeros((len(self._cells), len(self.COLUMNS)), dtype=np.int64)
+            if data:
+                data_cells = np.array([row[-1] for row in data], dtype=np.int64)
+                order = np.argsort(self._cells)
+                indexes = order[np.searchsorted(self._cells, data_cells, sorter=order)]
+                # The columns from 'number' to 'pedestrian_injury'
+                self._values[indexes] = [row[3:8] for row in data]
+        return self._values
+
+    @property
+    def distances(self):
+        """The distance in meters along the route to where each cell is first
+            passed."""
+
+        if self._distances is None:
+            points = self._coordinates.array
+            lengths = haversine(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1]) * 1000
+            cumulative = np.r_[0, np.cumsum(lengths)]
+            if len(lengths) == 0:
+                self._distances = np.zeros(len(self._cells))
             else:
-                self._pedestrian_injury = 0
-                for data in self.data:
-                    self._pedestrian_injury += data[7]
-        return self._pedestrian_injury
+                segments = np.minimum(np.floor(self._positions).astype(np.int64), len(lengths) - 1)
+                self._distances = cumulative[segments] + (self._positions - segments) * lengths[segments]
+        return self._distances
+
+    def by_points(self, point_groups, group_number):
+        """This method is used to add up the cells by the group of the point
+            starting the segment in which each of them is first passed.
+
+        :param point_groups: The group of each point of the route, e.g. the
+            index of its step.
+        :type point_groups: list of int
+
+        :param group_number: The number of groups.
+        :type group_number: int
+
+        :return: The totals of 'COLUMNS' of each group.
+        :rtype: list of dicts"""
+
+        points = np.minimum(np.floor(self._positions).astype(np.int64), len(point_groups) - 1)
+        return self._sum(np.asarray(point_groups, dtype=np.int64)[points], group_number)
+
+    def by_distance(self, meters):
+        """This method is used to add up the cells by parts of the route of a
+            length of 'meters', which must be at least 'MIN_SEGMENT_METERS'
+            and split the route into at most 'MAX_SEGMENT_NUMBER' parts.
+
+        :return: The totals of 'COLUMNS' of each part with the distances of
+            its 'start' and 'end' in meters.
+        :rtype: list of dicts"""
+
+        if not np.isfinite(meters) or meters < MIN_SEGMENT_METERS:
+            raise ValueError(f"The length of the segments must be a finite number of at least "
+                             f"{MIN_SEGMENT_METERS:.1f} meters")
+        group_number = int(self.distances.max() // meters) + 1 if len(self.distances) else 0
+        if group_number > MAX_SEGMENT_NUMBER:
+            raise ValueError(f"The route must not be split into more than {MAX_SEGMENT_NUMBER} segments")
+        groups = (self.distances // meters).astype(np.int64)
+        totals = self._sum(groups, group_number)
+        for index, total in enumerate(totals):
+            total["start"] = index * meters
+            total["end"] = (index + 1) * meters
+        return totals
+
+    def _sum(self, groups, group_number):
+        totals = np.zeros((group_number, len(self.COLUMNS)), dtype=np.int64)
+        np.add.at(totals, groups, self.values)
+        return [dict(zip(self.COLUMNS, total)) for total in totals.tolist()]
 
 class _DirectionEarthquakeData():
+    """This class is used to keep the earthquakes of the grid cells of a
+        route as one NumPy array per column instead of a tuple per
+        earthquake, deduplicated by their ids. The properties are None if
+        there is no earthquake, as before."""
+
+    # The columns of 'risk_earthquake' which are kept, by their positions
+    COLUMNS = {"id": 0, "date": 1, "time": 2, "latitude": 3, "longitude": 4, "magnitude": 5, "depth": 6}
+
     def __init__(self, coordinates):
-        self._coords = []
-        for coordinate in coordinates:
-            self._coords.append(Coordinate(coordinate))
+        self._coordinates = CoordinateArray(coordinates)
+        self._cells = rasterize(self._coordinates, EarthquakeSQLController.GRID_DIFFERENCE).tolist()
         self._data = None
-        self._number = None
-        self._date = None
-        self._time = None
-        self._latitude = None
-        self._longitude = None
-        self._coordinate = None
-        self._magnitude = None
-        self._depth = None
-        self._avg_magnitude = None
-        self._avg_depth = None
+        self._nearby = None
+
+    @property
+    def cells(self):
+        return self._cells
 
     @property
     def data(self):
+        """The columns of the earthquakes keyed by the names of 'COLUMNS', or
+            None if there is no earthquake."""
+
         if self._data is None:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future_to_coord = {executor.submit(self._get_earthquake_data, coord): coord for coord in self._coords}
-                data = []
-                for future in concurrent.futures.as_completed(future_to_coord):
-                    elements = future.result()
-                    if elements:
-                        data.extend(elements)
-            if len(data) == 0:
-                return None
-            else:
-                self._data = list(set(data))
+            with EarthquakeSQLController() as controller:
+                rows = controller.select_from_cells(self._cells)
+            self._data = self._to_columns(rows)
+        if len(self._data["id"]) == 0:
+            return None
         return self._data
 
-    def _get_earthquake_data(self, coord):
-        return coord.earthquake.data
+    @classmethod
+    def _to_columns(cls, rows):
+        columns = list(zip(*rows)) if rows else [()] * len(cls.COLUMNS)
+        ids, indexes = np.unique(np.array(columns[cls.COLUMNS["id"]], dtype=np.int64), return_index=True)
+        data = {"id": ids}
+        for name, position in cls.COLUMNS.items():
+            if name == "id":
+                continue
+            if name in ("date", "time"):
+                column = np.array(columns[position], dtype=str)
+            else:
+                column = np.array(columns[position], dtype=np.float64)
+            data[name] = column[indexes]
+        return data
+
+    @property
+    def nearby(self):
+        """The earthquakes whose epicenters are within 'EARTHQUAKE_RADIUS'
+            kilometers of any point of the route."""
+
+        if self._nearby is None:
+            self._nearby = self.within(EARTHQUAKE_RADIUS)
+        return self._nearby
+
+    def within(self, kilometers):
+        """Get the earthquakes whose epicenters are within a distance of any
+            point of the route, using the in-memory 'EarthquakeIndex' instead
+            of matching 0.01 degree grid cells in the database.
+
+        :param kilometers: The distance from the route.
+        :type kilometers: float"""
+
+        return EarthquakeIndex.get().within(self._coordinates, kilometers)
 
     @property
     def number(self):
-        if self._number is None:
-            if not self.data:
-                return 0
-            else:
-                self._number = len(self.data)
-        return self._number
+        if not self.data:
+            return 0
+        return len(self.data["id"])
 
     @property
     def date(self):
-        if self._date is None:
-            if not self.data:
-                return None
-            else:
-                self._date = []
-                for data in self.data:
-                    self._date.append(data[1])
-        return self._date
+        if not self.data:
+            return None
+        return self.data["date"]
 
     @property
     def time(self):
-        if self._time is None:
-            if not self.data:
-                return None
-            else:
-                self._time = []
-                for data in self.data:
-                    self._time.append(data[2])
-        return self._time
+        if not self.data:
+            return None
+        return self.data["time"]
 
     @property
     def latitude(self):
-        if self._latitude is None:
-            if not self.data:
-                return None
-            else:
-                self._latitude = []
-                for data in self.data:
-                    self._latitude.append(data[3])
-        return self._latitude
+        if not self.data:
+            return None
+        return self.data["latitude"]
 
     @property
     def longitude(self):
-        if self._longitude is None:
-            if not self.data:
-                return None
-            else:
-                self._longitude = []
-                for data in self.data:
-                    self._longitude.append(data[4])
-        return self._longitude
+        if not self.data:
+            return None
+        return self.data["longitude"]
 
     @property
     def coordinate(self):
-        if self._coordinate is None:
-            if not self.data:
-                return None
-            else:
-                self._coordinate = []
-                for data in self.data:
-                    self._coordinate.append((data[3], data[4]))
-        return self._coordinate
+        if not self.data:
+            return None
+        return np.column_stack([self.data["latitude"], self.data["longitude"]])
 
     @property
     def magnitude(self):
-        if self._magnitude is None:
-            if not self.data:
-                return None
-            else:
-                self._magnitude = []
-                for data in self.data:
-                    self._magnitude.append(data[5])
-        return self._magnitude
+        if not self.data:
+            return None
+        return self.data["magnitude"]
 
     @property
     def depth(self):
-        if self._depth is None:
-            if not self.data:
-                return None
-            else:
-                self._depth = []
-                for data in self.data:
-                    self._depth.append(data[6])
-        return self._depth
+        if not self.data:
+            return None
+        return self.data["depth"]
 
     @property
     def average_magnitude(self):
-        if self._avg_magnitude is None:
-            self._avg_magnitude = risk.average_magnitude(self.magnitude)
-        return self._avg_magnitude
+        if not self.data:
+            return None
+        return risk.average_magnitude(self.data["magnitude"])
 
     @property
     def average_depth(self):
-        if self._avg_depth is None:
-            try:
-                self._avg_depth = 0
-                for depth in self.depth:
-                    self._avg_depth += depth
-                self._avg_depth /= len(self.depth)
-            except:
-                return None
-        return self._avg_depth
+        if not self.data:
+            return None
+        return float(np.mean(self.data["depth"]))
+
+    def records(self):
+        """Get the date, the coordinate, the magnitude and the depth of each
+            earthquake as a list of dicts, e.g. for a JSON response."""
+
+        if not self.data:
+            return []
+        return [{"date": date, "coordinate": (latitude, longitude), "magnitude": magnitude, "depth": depth}
+                for date, latitude, longitude, magnitude, depth in zip(
+                    self.data["date"].tolist(), self.data["latitude"].tolist(),
+                    self.data["longitude"].tolist(), self.data["magnitude"].tolist(),
+                    self.data["depth"].tolist())]
 
 
 class Geocode():
@@ -514,7 +800,6 @@ class Hotspot():
             self._columns.append(("latitude", self._latitude))
             self._columns.append(("longitude", self._longitude))
 
-        self.controller = AttractionSQLController()
         self.data = []
         self.id = []
         self.name = []
@@ -529,7 +814,8 @@ class Hotspot():
         self._get_data()
 
     def _get_data(self):
-        self.data = self.controller.get_data_from_columns(self._columns)
+        with AttractionSQLController() as controller:
+            self.data = controller.get_data_from_columns(self._columns)
 
         for data in self.data:
             self.id.append(data[0])
@@ -570,7 +856,6 @@ class Foodspot():
             self._avg_price = avg_price
             self._columns.append(("avg_price", self._avg_price))
 
-        self.controller = RestaurantSQLController()
         self.data = []
         self.id = []
         self.name = []
@@ -589,7 +874,8 @@ class Foodspot():
         self._get_data()
 
     def _get_data(self):
-        self.data = self.controller.get_data_from_columns(self._columns)
+        with RestaurantSQLController() as controller:
+            self.data = controller.get_data_from_columns(self._columns)
 
         for data in self.data:
             self.id.append(data[0])
@@ -636,23 +922,24 @@ class OpeningHours:
 
 class TrafficAccidentData():
     def __init__(self):
-        self._controller = PedestrianHellSQLController()
-        self.number = GetSQLData(self._controller, "number", 3)
-        self.total_fatality = GetSQLData(self._controller, "total_fatality", 4)
-        self.total_injury = GetSQLData(self._controller, "total_injury", 5)
-        self.pedestrian_fatality = GetSQLData(self._controller, "pedestrian_fatality", 6)
-        self.pedestrian_injury = GetSQLData(self._controller, "pedestrian_injury", 7)
+        self.number = GetSQLData(PedestrianHellSQLController, "number", 3)
+        self.total_fatality = GetSQLData(PedestrianHellSQLController, "total_fatality", 4)
+        self.total_injury = GetSQLData(PedestrianHellSQLController, "total_injury", 5)
+        self.pedestrian_fatality = GetSQLData(PedestrianHellSQLController, "pedestrian_fatality", 6)
+        self.pedestrian_injury = GetSQLData(PedestrianHellSQLController, "pedestrian_injury", 7)
 
 class GetSQLData:
-    def __init__(self, controller, column, index):
-        self._controller = controller
+    def __init__(self, controller_class, column, index):
+        self._controller_class = controller_class
         self._column = column
         self._index = index
         self._data = None
 
     def sorting(self, number_of_data=None, is_ascending=False):
         if self._data is None:
-            self._data = self._controller.select_by_order(self._column, is_ascending)
+            # The connection is only borrowed while the data is fetched
+            with self._controller_class() as controller:
+                self._data = controller.select_by_order(self._column, is_ascending)
         if number_of_data:
             return self._data[:number_of_data]
         else:
@@ -686,6 +973,25 @@ def test_Direction():
     # print(direction.coordinates)
     pass
 
+def test_segment_risk():
+    # Lengths which are not finite or shorter than a grid cell are rejected
+    # before anything is allocated
+    direction = Direction([(25.0337, 121.5645), (25.0400, 121.5700)])
+    print(len(direction.segment_risk(100)))
+    for meters in (float("nan"), float("inf"), 1e-9, MIN_SEGMENT_METERS / 2):
+        try:
+            direction.segment_risk(meters)
+            print(f"{meters}: not rejected")
+        except ValueError as e:
+            print(f"{meters}: {e}")
+    direction = Direction([(21.9, 120.8), (25.3, 121.6)])
+    try:
+        direction.segment_risk(MIN_SEGMENT_METERS)
+        print("Too many segments: not rejected")
+    except ValueError as e:
+        print(e)
+    pass
+
 def test_Geocode():
     # address = "大稻埕碼頭"
     # address = "大稻埕碼頭_大稻埕碼頭貨櫃市集"
@@ -768,6 +1074,7 @@ def test_foodspot():
 if __name__ == "__main__":
     # test_DirectionAPI()
     # test_Direction()
+    # test_segment_risk()
     # test_Geocode()
     # test_Taiwan()
     # test_hotspot()
@@ -0,0 +1,80 @@
+# Generated by Django 5.0.5 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+def _cell_id(latitude, longitude, difference):
+    # Same packing as database.cell_id(), copied so that the migration does not
+    # depend on the current state of the application code
+    latitude_offset = round(90 / difference)
+    longitude_offset = round(180 / difference)
+    latitude_index = round(float(latitude) / difference) + latitude_offset
+    longitude_index = round(float(longitude) / difference) + longitude_offset
+    return latitude_index * (2 * longitude_offset + 1) + longitude_index
+
+
+def backfill_cell_id(apps, schema_editor):
+    TrafficAccident = apps.get_model("explorer", "TrafficAccident")
+    Earthquake = apps.get_model("explorer", "Earthquake")
+
+    # Rows of the same grid cell may have been stored more than once when the
+    # float comparison in 'coordinate_id' failed, so they are merged into the
+    # row with the smallest id before the unique index is created
+    kept = {}
+    duplicates = []
+    for accident in TrafficAccident.objects.order_by("id").iterator():
+        accident.cell_id = _cell_id(accident.latitude, accident.longitude, 0.0001)
+        existing = kept.get(accident.cell_id)
+        if existing is None:
+            kept[accident.cell_id] = accident
+        else:
+            existing.number += accident.number
+            existing.total_fatality += accident.total_fatality
+            existing.total_injury += accident.total_injury
+            existing.pedestrian_fatality += accident.pedestrian_fatality
+            existing.pedestrian_injury += accident.pedestrian_injury
+            duplicates.append(accident.id)
+    for index in range(0, len(duplicates), 500):
+        TrafficAccident.objects.filter(id__in=duplicates[index: index + 500]).delete()
+    TrafficAccident.objects.bulk_update(
+        kept.values(),
+        ["cell_id", "number", "total_fatality", "total_injury",
+         "pedestrian_fatality", "pedestrian_injury"],
+        batch_size=1000,
+    )
+
+    earthquakes = []
+    for earthquake in Earthquake.objects.iterator():
+        earthquake.cell_id = _cell_id(earthquake.latitude, earthquake.longitude, 0.01)
+        earthquakes.append(earthquake)
+    Earthquake.objects.bulk_update(earthquakes, ["cell_id"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("explorer", "0003_restaurant"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="trafficaccident",
+            name="cell_id",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="earthquake",
+            name="cell_id",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_cell_id, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="trafficaccident",
+            name="cell_id",
+            field=models.BigIntegerField(null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name="earthquake",
+            name="cell_id",
+            field=models.BigIntegerField(db_index=True, null=True),
+        ),
+    ]
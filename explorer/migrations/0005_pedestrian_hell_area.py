@@ -0,0 +1,46 @@
+# Generated by Django 5.0.5 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+def merge_areas(apps, schema_editor):
+    PedestrianHell = apps.get_model("explorer", "PedestrianHell")
+
+    # Every accident used to read and rewrite the row of its area on its own,
+    # so an area may have been stored more than once. The rows are merged
+    # into the one with the smallest id before the unique index is created
+    kept = {}
+    duplicates = []
+    for area in PedestrianHell.objects.order_by("id").iterator():
+        existing = kept.get((area.area_1, area.area_2))
+        if existing is None:
+            kept[(area.area_1, area.area_2)] = area
+        else:
+            existing.number += area.number
+            existing.total_fatality += area.total_fatality
+            existing.total_injury += area.total_injury
+            existing.pedestrian_fatality += area.pedestrian_fatality
+            existing.pedestrian_injury += area.pedestrian_injury
+            duplicates.append(area.id)
+    for index in range(0, len(duplicates), 500):
+        PedestrianHell.objects.filter(id__in=duplicates[index: index + 500]).delete()
+    PedestrianHell.objects.bulk_update(
+        kept.values(),
+        ["number", "total_fatality", "total_injury",
+         "pedestrian_fatality", "pedestrian_injury"],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("explorer", "0004_cell_id"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_areas, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="pedestrianhell",
+            constraint=models.UniqueConstraint(fields=["area_1", "area_2"], name="unique_pedestrian_hell_area"),
+        ),
+    ]
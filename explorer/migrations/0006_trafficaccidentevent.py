@@ -0,0 +1,46 @@
+# Generated by Django 5.0.5 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("explorer", "0005_pedestrian_hell_area"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TrafficAccidentEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("rank", models.IntegerField()),
+                ("date", models.DateField()),
+                ("time", models.TimeField()),
+                ("latitude", models.DecimalField(decimal_places=6, max_digits=10)),
+                ("longitude", models.DecimalField(decimal_places=6, max_digits=10)),
+                ("cell_id", models.BigIntegerField(db_index=True)),
+                ("area_1", models.TextField(max_length=5)),
+                ("area_2", models.TextField(max_length=10)),
+                ("fatality", models.IntegerField()),
+                ("injury", models.IntegerField()),
+                ("includes_pedestrian", models.BooleanField()),
+            ],
+            options={
+                "db_table": "risk_traffic_accident_event",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=["rank", "date", "time", "latitude", "longitude"],
+                        name="unique_traffic_accident_event",
+                    )
+                ],
+            },
+        ),
+    ]
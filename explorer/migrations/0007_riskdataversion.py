@@ -0,0 +1,36 @@
+# Generated by Django 5.0.5 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    RiskDataVersion = apps.get_model("explorer", "RiskDataVersion")
+    RiskDataVersion.objects.create(id=1, version=0)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("explorer", "0006_trafficaccidentevent"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RiskDataVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "db_table": "risk_data_version",
+            },
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
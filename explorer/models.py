@@ -8,6 +8,8 @@ class Earthquake(models.Model):
     longitude = models.DecimalField(max_digits=8, decimal_places=5)
     magnitude = models.DecimalField(max_digits=5, decimal_places=2)
     depth = models.DecimalField(max_digits=5, decimal_places=2)
+    # Packed 0.01 degree grid cell of the epicenter, see database.cell_id()
+    cell_id = models.BigIntegerField(null=True, db_index=True)
 
     class Meta:
         db_table = "risk_earthquake"
@@ -35,6 +37,8 @@ class TrafficAccident(models.Model):
     total_injury = models.IntegerField()
     pedestrian_fatality = models.IntegerField()
     pedestrian_injury = models.IntegerField()
+    # Packed 0.0001 degree grid cell, see database.cell_id()
+    cell_id = models.BigIntegerField(null=True, unique=True)
 
     class Meta:
         db_table = "risk_traffic_accident"
@@ -55,12 +59,54 @@ class PedestrianHell(models.Model):
 
     class Meta:
         db_table = "risk_pedestrian_hell"
+        constraints = [
+            models.UniqueConstraint(fields=["area_1", "area_2"], name="unique_pedestrian_hell_area"),
+        ]
 
     def __str__(self):
         return f"""{self.area_1} {self.area_2} -
                     Pedestrian Fatality: {self.pedestrian_fatality},
                     Pedestrian Total Injure: {self.pedestrian_injury}"""
 
+class TrafficAccidentEvent(models.Model):
+    # One row for each accident of 'CarAccident', which 'risk_traffic_accident'
+    # and 'risk_pedestrian_hell' can be rebuilt from
+    rank = models.IntegerField()
+    date = models.DateField()
+    time = models.TimeField()
+    latitude = models.DecimalField(max_digits=10, decimal_places=6)
+    longitude = models.DecimalField(max_digits=10, decimal_places=6)
+    # Packed 0.0001 degree grid cell, see database.cell_id()
+    cell_id = models.BigIntegerField(db_index=True)
+    area_1 = models.TextField(max_length=5)
+    area_2 = models.TextField(max_length=10)
+    fatality = models.IntegerField()
+    injury = models.IntegerField()
+    includes_pedestrian = models.BooleanField()
+
+    class Meta:
+        db_table = "risk_traffic_accident_event"
+        constraints = [
+            models.UniqueConstraint(fields=["rank", "date", "time", "latitude", "longitude"],
+                                    name="unique_traffic_accident_event"),
+        ]
+
+    def __str__(self):
+        return f"""A{self.rank} Traffic Accident on {self.date} {self.time} in ({self.latitude}, {self.longitude}) -
+                    Fatality: {self.fatality},
+                    Injure: {self.injury}"""
+
+class RiskDataVersion(models.Model):
+    # A single row which is raised whenever risk data is written, see
+    # database.database_generation()
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "risk_data_version"
+
+    def __str__(self):
+        return f"Risk Data Version: {self.version}"
+
 class Hotspot(models.Model):
     name = models.TextField(max_length=30)
     latitude = models.DecimalField(max_digits=10, decimal_places=6)
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from explorer.database import DEGREE_DIFFERENCE, CoordinateArray, SQLController, \
+                              TrafficAccidentSQLController, TrafficAccidentTotal, cell_indexes
+
+__all__ = ["RASTER_PATH", "build_traffic_accident_raster", "TrafficAccidentRaster"]
+
+
+"""
+The traffic accident raster is an on-disk copy of 'risk_traffic_accident'
+split into square tiles of 'TILE_SIZE' x 'TILE_SIZE' grid cells. Each tile is
+a pair of .npy files: the sorted cell ids of the occupied cells, and a
+matching array with one row of 'COLUMNS' values per cell. Lookups open the
+tiles with np.memmap, so every worker process shares the same pages through
+the page cache, and resolve a whole route per tile with np.searchsorted.
+"""
+
+RASTER_PATH = os.getenv("RISK_RASTER_PATH",
+                        os.path.join(SQLController.BASE_DIR, "explorer", "data", "raster"))
+# Number of grid cells on each side of a tile, i.e. 0.1 degree
+TILE_SIZE = 1000
+COLUMNS = ("id", "number", "total_fatality", "total_injury",
+           "pedestrian_fatality", "pedestrian_injury")
+CURRENT_JSON = "current.json"
+# Versions of the raster kept after a build, including the new one, since
+# workers switch to the new version at their next lookup
+RASTER_KEEP_VERSIONS = int(os.getenv("RASTER_KEEP_VERSIONS", 2))
+# Seconds an older version is kept for at least, for lookups in progress
+RASTER_GRACE_SECONDS = float(os.getenv("RASTER_GRACE_SECONDS", 3600))
+
+
+def _tile_keys(cells):
+    latitude_indexes, longitude_indexes = cell_indexes(cells)
+    return latitude_indexes // TILE_SIZE, longitude_indexes // TILE_SIZE
+
+def _tile_name(latitude_tile, longitude_tile):
+    return f"{latitude_tile}_{longitude_tile}"
+
+def build_traffic_accident_raster(path=RASTER_PATH):
+    """This method is used to write 'risk_traffic_accident' into a new
+        version of the raster and make it the current one.
+
+    Every build goes into its own directory and 'current.json' is replaced
+    atomically at the end, so workers reading the previous version are never
+    handed a half-written tile. The 'RASTER_KEEP_VERSIONS' newest versions
+    are kept, and older ones until they are 'RASTER_GRACE_SECONDS' old, so
+    that workers which have not switched yet can still open their tiles.
+
+    :return: The number of occupied cells written.
+    :rtype: int"""
+
+    with TrafficAccidentSQLController() as controller:
+        controller.cursor.execute(f"""SELECT cell_id, {", ".join(COLUMNS)}
+                                      FROM {controller.table_name}
+                                      WHERE cell_id IS NOT NULL""")
+        rows = np.array(controller.cursor.fetchall(), dtype=np.int64).reshape(-1, len(COLUMNS) + 1)
+
+    cells = rows[:, 0]
+    values = rows[:, 1:]
+    latitude_tiles, longitude_tiles = _tile_keys(cells)
+    # Sort by tile first and by cell id within a tile
+    order = np.lexsort((cells, longitude_tiles, latitude_tiles))
+    cells, values = cells[order], values[order]
+    latitude_tiles, longitude_tiles = latitude_tiles[order], longitude_tiles[order]
+
+    version = str(time.time_ns())
+    version_path = os.path.join(path, version)
+    shutil.rmtree(version_path, ignore_errors=True)
+    os.makedirs(version_path)
+    boundaries = np.flatnonzero((np.diff(latitude_tiles) != 0) | (np.diff(longitude_tiles) != 0)) + 1
+    tiles = []
+    for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(cells)]):
+        if start == end:
+            continue
+        name = _tile_name(latitude_tiles[start], longitude_tiles[start])
+        np.save(os.path.join(version_path, f"{name}.cells.npy"), cells[start:end])
+        np.save(os.path.join(version_path, f"{name}.values.npy"), values[start:end])
+        tiles.append(name)
+
+    # A tile which is not listed has no accident at all
+    current = {"version": version, "tile_size": TILE_SIZE,
+               "degree_difference": DEGREE_DIFFERENCE, "columns": COLUMNS,
+               "size": len(cells), "tiles": tiles}
+    temporary_path = os.path.join(path, f"{CURRENT_JSON}.tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(current, file)
+    os.replace(temporary_path, os.path.join(path, CURRENT_JSON))
+
+    versions = sorted((name for name in os.listdir(path)
+                       if name.isdigit() and os.path.isdir(os.path.join(path, name))), key=int)
+    for name in versions[:-RASTER_KEEP_VERSIONS]:
+        if time.time_ns() - int(name) > RASTER_GRACE_SECONDS * 1e9:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return len(cells)
+
+
+class TrafficAccidentRaster:
+    """This class is used to look up the traffic accident raster written by
+        'build_traffic_accident_raster()'.
+
+    It has the same lookup methods as 'TrafficAccidentSQLController', so it
+    can be returned by 'database.traffic_accident_source()'. The rows it
+    returns are rebuilt from the tiles in the column order of the table.
+
+    Use 'TrafficAccidentRaster.get()' to share one instance per process; it
+    switches to the new version after a rebuild."""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, path=RASTER_PATH):
+        self.path = path
+        self.version = None
+        self._stamp = None
+        self._tiles = {}
+        self.reload()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            elif cls._instance._stamp != cls._instance._current_stamp():
+                cls._instance.reload()
+        return cls._instance
+
+    def _current_stamp(self):
+        try:
+            return os.stat(os.path.join(self.path, CURRENT_JSON)).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self):
+        self._stamp = self._current_stamp()
+        with open(os.path.join(self.path, CURRENT_JSON)) as file:
+            current = json.load(file)
+        if current["tile_size"] != TILE_SIZE or current["degree_difference"] != DEGREE_DIFFERENCE:
+            raise ValueError("The raster was built with another grid. Please rebuild it.")
+        if "tiles" not in current:
+            raise ValueError("The raster was built without a list of its tiles. Please rebuild it.")
+        self.version = current["version"]
+        self._names = set(current["tiles"])
+        self._tiles = {}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _tile(self, latitude_tile, longitude_tile):
+        key = (latitude_tile, longitude_tile)
+        if key not in self._tiles:
+            name = _tile_name(latitude_tile, longitude_tile)
+            if name not in self._names:
+                # No accident has ever happened in this tile
+                self._tiles[key] = None
+                return None
+            try:
+                self._tiles[key] = self._load_tile(name)
+            except FileNotFoundError:
+                # The version has been deleted after a newer build, so the
+                # tile is looked up in the current one instead
+                if self._stamp == self._current_stamp():
+                    raise
+                self.reload()
+                return self._tile(latitude_tile, longitude_tile)
+        return self._tiles[key]
+
+    def _load_tile(self, name):
+        name = os.path.join(self.path, self.version, name)
+        return (np.load(f"{name}.cells.npy", mmap_mode="r"),
+                np.load(f"{name}.values.npy", mmap_mode="r"))
+
+    def lookup(self, cells):
+        """This method is used to find the values of a batch of cells.
+
+        :param cells: The cell ids determined by 'database.cell_id()'.
+        :type cells: iterable of int
+
+        :return: The sorted unique cell ids, their values with one row of
+            'COLUMNS' per cell, zero where nothing was found, and a boolean
+            mask of the cells which were found.
+        :rtype: a tuple of three numpy arrays"""
+
+        if not isinstance(cells, np.ndarray):
+            cells = np.fromiter(cells, dtype=np.int64)
+        cells = np.unique(cells.astype(np.int64))
+        values = np.zeros((len(cells), len(COLUMNS)), dtype=np.int64)
+        found = np.zeros(len(cells), dtype=bool)
+        if len(cells) == 0:
+            return cells, values, found
+
+        # Group the cells by tile so that each tile is searched once
+        latitude_tiles, longitude_tiles = _tile_keys(cells)
+        order = np.lexsort((longitude_tiles, latitude_tiles))
+        latitude_tiles, longitude_tiles = latitude_tiles[order], longitude_tiles[order]
+        boundaries = np.flatnonzero((np.diff(latitude_tiles) != 0) | (np.diff(longitude_tiles) != 0)) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(cells)]):
+            tile = self._tile(int(latitude_tiles[start]), int(longitude_tiles[start]))
+            if tile is None:
+                continue
+            tile_cells, tile_values = tile
+            positions = order[start:end]
+            queried = cells[positions]
+            slots = np.minimum(np.searchsorted(tile_cells, queried), len(tile_cells) - 1)
+            hits = tile_cells[slots] == queried
+            values[positions[hits]] = tile_values[slots[hits]]
+            found[positions[hits]] = True
+        return cells, values, found
+
+    def select_from_cells(self, cells):
+        cells, values, found = self.lookup(cells)
+        cells, values = cells[found], values[found]
+        latitude_indexes, longitude_indexes = cell_indexes(cells)
+        latitudes = np.round(latitude_indexes * DEGREE_DIFFERENCE, 4)
+        longitudes = np.round(longitude_indexes * DEGREE_DIFFERENCE, 4)
+        return [(row[0], latitude, longitude, *row[1:], cell)
+                for row, latitude, longitude, cell in zip(values.tolist(), latitudes.tolist(),
+                                                          longitudes.tolist(), cells.tolist())]
+
+    def aggregate_from_cells(self, cells):
+        _, values, found = self.lookup(cells)
+        # The columns after 'id'
+        return TrafficAccidentTotal(int(found.sum()), *values[found, 1:].sum(axis=0).tolist())
+
+    def select_from_coordinate(self, latitude, longitude):
+        data = self.select_from_coordinates([(latitude, longitude)])
+        if data:
+            return data
+        else:
+            return None
+
+    def select_from_coordinates(self, coordinates):
+        return self.select_from_cells(CoordinateArray(coordinates).cells())
+
+
+def test_TrafficAccidentRaster():
+    build_traffic_accident_raster()
+    raster = TrafficAccidentRaster.get()
+    print(raster.select_from_coordinate(25.0337, 121.5645))
+    pass
+
+
+if __name__ == "__main__":
+    # test_TrafficAccidentRaster()
+    pass
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 SEISMIC_INTENSITY_SCALE = {
     # PGA, Peak Ground Acceleration (cm/sec^2), is a measure of the maximum acceleration experienced by the ground during an earthquake.
@@ -74,14 +75,20 @@ def pga_to_intensity(pga):
         return "error"
 
 def average_magnitude(magnitudes):
-    if magnitudes:
-        avg = 0
-        for magnitude in magnitudes:
-            avg += 10 ** magnitude
-        avg /= len(magnitudes)
-        return math.log10(avg)
-    else:
+    """This method is used to average magnitudes by their energies, i.e. the
+        base-10 logarithm of the mean of 10 ** magnitude, so that one strong
+        earthquake is not outweighed by many weak ones.
+
+    :param magnitudes: The magnitudes.
+    :type magnitudes: list of float or numpy.ndarray
+
+    :return: The average magnitude, or None without any magnitude.
+    :rtype: float or None"""
+
+    magnitudes = np.asarray(magnitudes, dtype=np.float64)
+    if magnitudes.size == 0:
         return None
+    return float(np.log10(np.mean(10 ** magnitudes)))
 
 def average_depth(depths):
     if depths:
@@ -109,6 +116,9 @@ def test_magnitude():
     magnitudes = [1, 2, 3, 4, 5, 6]
     avg = average_magnitude(magnitudes)
     print(avg)
+    # Equal magnitudes average to themselves, and one magnitude 6 outweighs
+    # ten of magnitude 4, unlike the arithmetic mean
+    print(average_magnitude(np.array([5.0, 5.0])), average_magnitude([6] + [4] * 10), average_magnitude([]))
 
 if __name__ == "__main__":
     # test_intensity()
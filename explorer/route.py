@@ -0,0 +1,416 @@
+import os
+import sys
+import math
+import time
+import threading
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from explorer.database import DEGREE_DIFFERENCE, CoordinateArray, EarthquakeSQLController, cell_ids, \
+                              database_generation, recent_database_generation
+
+__all__ = ["SIMPLIFY_ROUTES", "simplify", "rasterize", "corridor_cells", "haversine", "EarthquakeIndex"]
+
+
+# Mean radius of the earth in meters
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# Whether 'views.map' simplifies the routes sent by the browser before their
+# risk is looked up, and how far in degrees a dropped point may lie from the
+# simplified route, i.e. half of a grid cell
+SIMPLIFY_ROUTES = os.getenv("SIMPLIFY_ROUTES", "false").lower() == "true"
+SIMPLIFY_TOLERANCE = DEGREE_DIFFERENCE / 2
+# Size of the buckets of 'EarthquakeIndex' in degrees, i.e. about 11 km
+EPICENTER_BUCKET_DIFFERENCE = 0.1
+# Finest grid a route is snapped to before it is compared with all of the
+# epicenters, i.e. about 110 m
+EPICENTER_ROUTE_DIFFERENCE = 0.001
+# Number of route points compared with the epicenters at once
+EPICENTER_CHUNK_SIZE = 1024
+
+
+def _as_array(coordinates):
+    """This method is used to turn a list of (latitude, longitude) tuples or
+        of {"lat": ..., "lng": ...} dictionaries into a validated N x 2 array,
+        see 'database.CoordinateArray'."""
+
+    return CoordinateArray(coordinates).array
+
+def _cell_id_width(difference):
+    # The number of longitude indexes in a row of 'database.cell_id()'
+    return 2 * round(180 / difference) + 1
+
+def _ranges(starts, counts):
+    # Concatenation of range(start, start + count) for every pair
+    first_positions = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - first_positions
+
+def _snap(coordinates, difference):
+    # The unique points of a route after rounding them to a grid
+    return np.unique(np.round(coordinates / difference), axis=0) * difference
+
+def simplify(coordinates, tolerance=SIMPLIFY_TOLERANCE):
+    """This method is used to drop the points of a route which hardly change
+        its shape with the Douglas-Peucker algorithm.
+
+    Routes from the browser contain every point of every step, and most of
+    them lie on a straight line with their neighbors. A point is only kept if
+    it is further than 'tolerance' degrees from the line between the points
+    kept around it, so with the default of half a grid cell the simplified
+    route passes through nearly the same cells. Repeated points are dropped
+    first.
+
+    :param coordinates: The points of the route, in order.
+    :type coordinates: list of tuples, list of dicts, or an N x 2 array
+
+    :param tolerance: The largest distance in degrees of a dropped point.
+    :type tolerance: float
+
+    :return: The points which are kept and the number of dropped points.
+    :rtype: a tuple of an N x 2 array and an int"""
+
+    coordinates = _as_array(coordinates)
+    size = len(coordinates)
+    if size > 1:
+        is_repeated = np.r_[False, np.all(coordinates[1:] == coordinates[:-1], axis=1)]
+        coordinates = coordinates[~is_repeated]
+    if len(coordinates) < 3:
+        return coordinates, size - len(coordinates)
+
+    is_kept = np.zeros(len(coordinates), dtype=bool)
+    is_kept[[0, -1]] = True
+    ranges = [(0, len(coordinates) - 1)]
+    while ranges:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        points = coordinates[start + 1: end]
+        direction = coordinates[end] - coordinates[start]
+        offsets = points - coordinates[start]
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            middle = start + 1 + index
+            is_kept[middle] = True
+            ranges += [(start, middle), (middle, end)]
+    return coordinates[is_kept], size - int(is_kept.sum())
+
+def _pack(latitude_indexes, longitude_indexes, difference):
+    # The same packing as 'database.cell_id()' for integer grid indexes
+    return ((latitude_indexes + round(90 / difference)) * _cell_id_width(difference)
+            + longitude_indexes + round(180 / difference))
+
+def _crossings(starts, ends):
+    """This method is used to find where each segment crosses the grid lines
+        of one axis, as fractions of the segment from 0 to 1.
+
+    Cells are found by rounding, so the grid lines lie halfway between the
+    grid indexes, i.e. at k + 0.5.
+
+    :return: The segment of each crossing and the fraction at it.
+    :rtype: a tuple of two numpy arrays"""
+
+    lows = np.floor(np.minimum(starts, ends) + 0.5).astype(np.int64)
+    highs = np.floor(np.maximum(starts, ends) + 0.5).astype(np.int64)
+    counts = highs - lows
+    segments = np.repeat(np.arange(len(starts)), counts)
+    lines = _ranges(lows, counts) + 0.5
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = (lines - starts[segments]) / (ends[segments] - starts[segments])
+    return segments, fractions
+
+def rasterize(coordinates, difference=DEGREE_DIFFERENCE, return_positions=False):
+    """This method is used to determine every grid cell a route passes
+        through, in the order they are passed, rather than only the cells its
+        points fall in.
+
+    Each segment between two consecutive points is cut where it crosses a
+    grid line, and the cell of the middle of every piece is taken, which is
+    the grid traversal of the segment. A segment passing exactly through the
+    corner of four cells gets one of the two cells beside the corner. All
+    segments are cut at once, so a route of 10,000 points takes milliseconds.
+
+    :param coordinates: The points of the route, in order.
+    :type coordinates: list of tuples, list of dicts, or an N x 2 array
+
+    :param difference: The degree difference of the grid.
+    :type difference: float
+
+    :param return_positions: Whether to also return where along the route
+        each cell is first passed, as the index of the segment plus the
+        fraction of the segment, e.g. 2.5 is halfway between the points 2
+        and 3. It tags every cell with its step or distance in one pass.
+    :type return_positions: bool
+
+    :return: The cell ids, see 'database.cell_id()', each only at the first
+        time it is passed, and their positions if 'return_positions'.
+    :rtype: numpy array, or a tuple of two numpy arrays"""
+
+    coordinates = _as_array(coordinates)
+    if len(coordinates) == 0:
+        if return_positions:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.empty(0, dtype=np.int64)
+    grid = coordinates / difference
+    starts, ends = grid[:-1], grid[1:]
+
+    latitude_segments, latitude_fractions = _crossings(starts[:, 0], ends[:, 0])
+    longitude_segments, longitude_fractions = _crossings(starts[:, 1], ends[:, 1])
+    # Every segment is also cut at its own start and end
+    segments = np.concatenate([np.arange(len(starts)), np.arange(len(starts)),
+                               latitude_segments, longitude_segments])
+    fractions = np.concatenate([np.zeros(len(starts)), np.ones(len(starts)),
+                                latitude_fractions, longitude_fractions])
+    order = np.lexsort((fractions, segments))
+    segments, fractions = segments[order], fractions[order]
+
+    # The middle of each piece between two cuts of the same segment
+    is_piece = segments[1:] == segments[:-1]
+    piece_segments = segments[:-1][is_piece]
+    middles = ((fractions[:-1] + fractions[1:]) / 2)[is_piece]
+    points = starts[piece_segments] + middles[:, None] * (ends[piece_segments] - starts[piece_segments])
+    points = np.concatenate([grid[:1], points, grid[-1:]])
+
+    cells = _pack(np.rint(points[:, 0]).astype(np.int64), np.rint(points[:, 1]).astype(np.int64), difference)
+    _, first_indexes = np.unique(cells, return_index=True)
+    first_indexes = np.sort(first_indexes)
+    if return_positions:
+        positions = np.concatenate([[0], piece_segments + middles, [len(grid) - 1]])
+        return cells[first_indexes], positions[first_indexes]
+    return cells[first_indexes]
+
+def corridor_cells(coordinates, meters, difference=DEGREE_DIFFERENCE):
+    """This method is used to determine the grid cells whose centers are
+        within a distance of the cells of a route, i.e. a buffer around it.
+        The cells of the route are those of 'rasterize()', so the buffer
+        also covers the segments between points far apart, e.g. on highways.
+
+    The disk around each cell of the route is described by one interval of
+    cells per grid row. Since consecutive cells of a route overlap almost
+    entirely, the intervals are merged per row before they are expanded, so
+    the work grows with the size of the buffer rather than with the number
+    of points times the area of the disk. The disk is measured at the mean
+    latitude of the route, which is within a few percent everywhere in
+    Taiwan.
+
+    :param coordinates: The points of the route.
+    :type coordinates: list of tuples, list of dicts, or an N x 2 array
+
+    :param meters: The width of the buffer on each side of the route.
+    :type meters: float
+
+    :return: The sorted unique cell ids in the buffer.
+    :rtype: numpy array"""
+
+    coordinates = _as_array(coordinates)
+    if len(coordinates) == 0:
+        return np.empty(0, dtype=np.int64)
+    route_cells = np.unique(rasterize(coordinates, difference))
+
+    cell_height = difference * METERS_PER_DEGREE
+    cell_width = cell_height * math.cos(math.radians(coordinates[:, 0].mean()))
+    latitude_radius = math.floor(meters / cell_height)
+    latitude_offsets = np.arange(-latitude_radius, latitude_radius + 1)
+    # Half of the width of the disk in each row, in cells
+    half_widths = np.floor(np.sqrt(np.maximum(meters ** 2 - (latitude_offsets * cell_height) ** 2, 0))
+                           / cell_width).astype(np.int64)
+
+    # Cell ids are linear in the grid indexes, so the intervals of a row are
+    # ranges of cell ids which never reach into the next row
+    centers = (route_cells[:, None] + latitude_offsets * _cell_id_width(difference)).ravel()
+    starts = centers - np.tile(half_widths, len(route_cells))
+    ends = centers + np.tile(half_widths, len(route_cells))
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+
+    # An interval starts a new group unless it touches the ones before it
+    is_new = np.r_[True, starts[1:] > ends[:-1] + 1]
+    group_starts = starts[is_new]
+    group_ends = np.r_[ends[np.flatnonzero(is_new)[1:] - 1], ends[-1]]
+
+    return _ranges(group_starts, group_ends - group_starts + 1)
+
+def haversine(latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+    """This method is used to determine the great-circle distances in
+        kilometers between two arrays of points."""
+
+    latitudes_1, longitudes_1 = np.radians(latitudes_1), np.radians(longitudes_1)
+    latitudes_2, longitudes_2 = np.radians(latitudes_2), np.radians(longitudes_2)
+    a = (np.sin((latitudes_2 - latitudes_1) / 2) ** 2
+         + np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS / 1000 * np.arcsin(np.sqrt(a))
+
+
+class EarthquakeIndex:
+    """This class is used to keep every epicenter of 'risk_earthquake' in
+        memory, hashed into buckets of 'EPICENTER_BUCKET_DIFFERENCE' degrees,
+        to find the earthquakes near a whole route in one call.
+
+    'within()' only compares a route point with the epicenters in the
+    buckets around it, first with the route snapped to a grid and then with
+    the points themselves for the epicenters the snapping leaves in doubt,
+    so the result is exact rather than limited to grid cells.
+
+    Use 'EarthquakeIndex.get()' to share one instance per process; a new one
+    is built when the risk data has been written since, which is checked at
+    most every 'database.DATABASE_GENERATION_TTL' seconds."""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.generation = None
+        self.reload()
+
+    @classmethod
+    def get(cls):
+        # See 'database.TrafficAccidentIndex.get()'. A new index is built
+        # rather than reloading this one, whose arrays may be in use
+        generation = recent_database_generation()
+        instance = cls._instance
+        if instance is not None and instance.generation >= generation:
+            return instance
+        with cls._lock:
+            if cls._instance is None or cls._instance.generation < generation:
+                cls._instance = cls()
+            return cls._instance
+
+    def reload(self):
+        generation = database_generation()
+        with EarthquakeSQLController() as controller:
+            rows = controller.select()
+        latitudes = np.array([row[3] for row in rows], dtype=np.float64)
+        longitudes = np.array([row[4] for row in rows], dtype=np.float64)
+        buckets = cell_ids(latitudes, longitudes, EPICENTER_BUCKET_DIFFERENCE)
+        order = np.argsort(buckets, kind="stable")
+        self._rows = [rows[index] for index in order]
+        self._buckets = buckets[order]
+        self._latitudes = latitudes[order]
+        self._longitudes = longitudes[order]
+        self.generation = generation
+
+    def within(self, coordinates, kilometers):
+        """This method is used to get the earthquakes whose epicenters are
+            within a distance of any point of a route.
+
+        :param coordinates: The points of the route.
+        :type coordinates: list of tuples, list of dicts, or an N x 2 array
+
+        :param kilometers: The distance from the route.
+        :type kilometers: float
+
+        :return: The rows of 'risk_earthquake', in no particular order.
+        :rtype: list"""
+
+        coordinates = _as_array(coordinates)
+        if len(coordinates) == 0 or len(self._rows) == 0:
+            return []
+
+        # The route is first snapped to a coarse grid, which moves no point
+        # by more than 'error' and so settles every epicenter clearly inside
+        # or outside the distance. Only those in the thin shell in between
+        # are compared with the points of the route themselves.
+        coarse_difference = max(EPICENTER_ROUTE_DIFFERENCE, kilometers / 10 / (METERS_PER_DEGREE / 1000))
+        error = coarse_difference * math.sqrt(2) / 2 * METERS_PER_DEGREE / 1000
+        distances = self._distances(_snap(coordinates, coarse_difference), kilometers + error,
+                                    np.arange(len(self._rows)))
+        is_near = distances <= kilometers - error
+        candidates = np.flatnonzero(~is_near & (distances <= kilometers + error))
+        distances = self._distances(np.unique(coordinates, axis=0), kilometers, candidates)
+        is_near[candidates[distances <= kilometers]] = True
+        return [self._rows[index] for index in np.flatnonzero(is_near)]
+
+    def _distances(self, points, kilometers, candidates):
+        """This method is used to determine the distance from each candidate
+            epicenter to the nearest of the points, as far as it is within
+            'kilometers', and infinity otherwise.
+
+        :param candidates: The positions of the epicenters to measure, in
+            ascending order so that their buckets stay sorted.
+        :type candidates: numpy array"""
+
+        buckets = self._buckets[candidates]
+        latitudes = self._latitudes[candidates]
+        longitudes = self._longitudes[candidates]
+        distances = np.full(len(candidates), np.inf)
+        if len(candidates) == 0:
+            return distances
+        point_buckets = cell_ids(points[:, 0], points[:, 1], EPICENTER_BUCKET_DIFFERENCE)
+
+        bucket_height = EPICENTER_BUCKET_DIFFERENCE * METERS_PER_DEGREE / 1000
+        bucket_width = bucket_height * math.cos(math.radians(np.abs(points[:, 0]).max() + EPICENTER_BUCKET_DIFFERENCE))
+        latitude_radius = math.ceil(kilometers / bucket_height)
+        longitude_radius = math.ceil(kilometers / bucket_width)
+        latitude_offsets, longitude_offsets = np.mgrid[-latitude_radius: latitude_radius + 1,
+                                                       -longitude_radius: longitude_radius + 1]
+        offsets = (latitude_offsets * _cell_id_width(EPICENTER_BUCKET_DIFFERENCE) + longitude_offsets).ravel()
+        latitude_degrees = kilometers / bucket_height * EPICENTER_BUCKET_DIFFERENCE
+        longitude_degrees = kilometers / bucket_width * EPICENTER_BUCKET_DIFFERENCE
+
+        for start in range(0, len(points), EPICENTER_CHUNK_SIZE):
+            chunk = points[start: start + EPICENTER_CHUNK_SIZE]
+            neighbors = (point_buckets[start: start + EPICENTER_CHUNK_SIZE, None] + offsets).ravel()
+            lefts = np.searchsorted(buckets, neighbors, side="left")
+            counts = np.searchsorted(buckets, neighbors, side="right") - lefts
+            pair_points = np.repeat(np.arange(len(neighbors)) // len(offsets), counts)
+            pair_epicenters = _ranges(lefts, counts)
+            # A bounding box drops most pairs before the haversine distance
+            in_box = ((np.abs(chunk[pair_points, 0] - latitudes[pair_epicenters]) <= latitude_degrees)
+                      & (np.abs(chunk[pair_points, 1] - longitudes[pair_epicenters]) <= longitude_degrees))
+            pair_points, pair_epicenters = pair_points[in_box], pair_epicenters[in_box]
+            np.minimum.at(distances, pair_epicenters,
+                          haversine(chunk[pair_points, 0], chunk[pair_points, 1],
+                                    latitudes[pair_epicenters], longitudes[pair_epicenters]))
+        distances[distances > kilometers] = np.inf
+        return distances
+
+
+def test_simplify():
+    # Benchmark of the route of 'DIRECTIONS' and of a dense synthetic route
+    # with and without simplification
+    from explorer.maps import DirectionAPI
+    rng = np.random.default_rng(0)
+    steps = np.linspace(0, 1, 20000)[:, None]
+    routes = {
+        "DIRECTIONS": np.asarray(DirectionAPI().coordinates),
+        "synthetic": (np.array([25.03, 121.56]) + steps * [0.05, 0.08]
+                      + rng.normal(0, DEGREE_DIFFERENCE / 10, (len(steps), 2))),
+    }
+    for name, coordinates in routes.items():
+        start = time.perf_counter()
+        cells = rasterize(coordinates)
+        unsimplified_time = time.perf_counter() - start
+        start = time.perf_counter()
+        simplified, dropped = simplify(coordinates)
+        simplified_cells = rasterize(simplified)
+        simplified_time = time.perf_counter() - start
+        different = len(np.setxor1d(cells, simplified_cells))
+        print(f"{name}: {len(coordinates)} points, {dropped} dropped")
+        print(f"    unsimplified: {len(cells)} cells in {unsimplified_time * 1000:.1f} ms")
+        print(f"    simplified: {len(simplified_cells)} cells in {simplified_time * 1000:.1f} ms, "
+              f"{different} cells different")
+    pass
+
+def test_rasterize():
+    # Two points about 1 km apart on a straight road
+    coordinates = [(25.0337, 121.5645), (25.0400, 121.5700)]
+    cells = rasterize(coordinates)
+    print(len(cells))
+    pass
+
+def test_corridor_cells():
+    coordinates = [(25.0337, 121.5645), (25.0338, 121.5646), (25.0400, 121.5700)]
+    cells = corridor_cells(coordinates, 30)
+    print(len(cells))
+    pass
+
+
+if __name__ == "__main__":
+    # test_simplify()
+    # test_rasterize()
+    # test_corridor_cells()
+    pass
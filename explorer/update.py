@@ -1,6 +1,7 @@
 import time
-from database import UpdateTrafficAccidentData, UpdateEarthquakeData, \
-                     UpdateAttractionData, UpdateRestaurantData
+from database import UpdateTrafficAccidentData, RebuildTrafficAccidentData, \
+                     UpdateEarthquakeData, UpdateAttractionData, UpdateRestaurantData
+from raster import build_traffic_accident_raster
 
 
 def update_traffic_accident_data(count=1):
@@ -24,6 +25,30 @@ def update_traffic_accident_data(count=1):
     print(f"{records} records were successfully added to the database!")
     print(f"Total Execution Time: {execution_time/60:.1f} minutes ({execution_time/60/60:.1f} hours)")
 
+def catch_up_traffic_accident_data():
+    print("Start catching up TrafficAccident table.")
+    print("Collecting data...")
+    start_time = time.time()
+    update = UpdateTrafficAccidentData(catch_up=True)
+    end_time = time.time()
+    execution_time = end_time - start_time
+    print("----------------")
+    print("Update finished!")
+    print(f"{update.number_of_data} records were successfully added to the database!")
+    print(f"Total Execution Time: {execution_time:.2f} seconds ({execution_time/60:.2f} minutes)")
+
+def rebuild_traffic_accident_data():
+    print("Start rebuilding TrafficAccident table from the accidents.")
+    start_time = time.time()
+    rebuild = RebuildTrafficAccidentData()
+    end_time = time.time()
+    execution_time = end_time - start_time
+    print("----------------")
+    print("Rebuild finished!")
+    print(f"{rebuild.number_of_data} missing records were loaded from the csv files!")
+    print(f"{rebuild.cell_number} grid cells and {rebuild.area_number} areas were written to the database!")
+    print(f"Total Execution Time: {execution_time:.2f} seconds ({execution_time/60:.2f} minutes)")
+
 def update_earthquake_data(count=1):
     print("Start updating Earthquake table.")
     print("----------------")
@@ -45,6 +70,17 @@ def update_earthquake_data(count=1):
     print(f"{records} records were successfully added to the database!")
     print(f"Total Execution Time: {execution_time/60:.1f} minutes ({execution_time/60/60:.1f} hours)")
 
+def build_raster():
+    print("Start building TrafficAccident raster.")
+    start_time = time.time()
+    size = build_traffic_accident_raster()
+    end_time = time.time()
+    execution_time = end_time - start_time
+    print("----------------")
+    print("Build finished!")
+    print(f"{size} grid cells were written to the raster!")
+    print(f"Total Execution Time: {execution_time:.2f} seconds")
+
 def updata_hotspot_data():
     print("Start updating Hotspot table.")
     print("Collecting data...")
@@ -72,6 +108,9 @@ def updata_hotspot_data():
 
 if __name__ == "__main__":
     # update_traffic_accident_data()
+    # catch_up_traffic_accident_data()
+    # rebuild_traffic_accident_data()
+    # build_raster()
     # print()
     update_earthquake_data()
     # updata_hotspot_data()
@@ -29,4 +29,11 @@ urlpatterns = [
     url(r'^map/', views.map, name='map'),
     url(r'^travel/', views.travel, name='travel'),
     url(r'^travel_map/', views.travel_map, name='travel_map'),
+    url(r'^compare/', views.compare, name='compare'),
+    url(r'^executor_metrics/', views.executor_metrics, name='executor_metrics'),
+    # Asynchronous versions for ASGI servers, see 'safepath/asgi.py'
+    url(r'^async/map/', views.map_async, name='map_async'),
+    url(r'^async/compare/', views.compare_async, name='compare_async'),
+    url(r'^async/travel/', views.travel_async, name='travel_async'),
+    url(r'^async/travel_map/', views.travel_map_async, name='travel_map_async'),
 ]
@@ -1,18 +1,39 @@
+from asgiref.sync import sync_to_async
 from django.contrib import auth
 from django.core.mail import send_mail
 from django.db import IntegrityError
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.views.decorators.csrf import csrf_exempt
-from explorer.database import AttractionSQLController, RestaurantSQLController, rounding
-from explorer.maps import Direction, DirectionAPI, Hotspot, Foodspot, GOOGLE_MAPS_API_KEY
+from django.views.decorators.http import require_POST
+from googlemaps.exceptions import ApiError, Timeout, TransportError
+from explorer.database import AttractionSQLController, RestaurantSQLController, CoordinateArray, \
+                              EarthquakeSQLController, InvalidCoordinateError, route_executor, \
+                              traffic_accident_source
+from explorer.maps import Direction, DirectionAPI, Directions, Hotspot, Foodspot, GOOGLE_MAPS_API_KEY, \
+                          check_step_point_numbers
+from explorer.cache import route_risk_cache, route_risk_key
 from explorer.models import UserInfo
-from explorer.risk import average_magnitude, average_depth
+from explorer.route import SIMPLIFY_ROUTES, simplify
+import explorer.risk as risk
 import json
+import math
+import queue
 import random
+import threading
 import time
 
 
+# Number of traffic accident grid cells looked up before each line of a
+# streaming response of 'map'
+RISK_LOADING_NUMBER = 500
+# Number of earthquake grid cells looked up before each line of it
+EARTHQUAKE_LOADING_NUMBER = 100
+# Statuses of the Directions API which are not caused by the request itself
+DIRECTIONS_UNAVAILABLE_STATUSES = ("OVER_DAILY_LIMIT", "OVER_QUERY_LIMIT", "REQUEST_DENIED", "UNKNOWN_ERROR")
+
+
 def index(request):
     if 'username' in request.session:
         user = request.session['username']
@@ -24,95 +45,240 @@ def home(request):
     return redirect('/explorer/index')
 
 def map(request):
-    def coordinate_set(coordinates, difference):
-        coords = []
-        for coordinate in coordinates:
-            latitude = rounding(coordinate["lat"], difference)
-            longitude = rounding(coordinate["lng"], difference)
-            coords.append((latitude, longitude))
-        return list(set(coords))
-
-    RISK_LOADING_NUMBER = 100
-
     if request.method == 'POST':
         coordinates = request.POST.get('coordinates', '')
         try:
             if not coordinates:
                 raise ValueError('No coordinates provided')
-            coordinates = json.loads(coordinates)
+            coordinates = CoordinateArray(json.loads(coordinates))
             # print('Parsed coordinates:', coordinates)
-        except (json.JSONDecodeError, ValueError) as e:
+        except (json.JSONDecodeError, ValueError, InvalidCoordinateError) as e:
             print('Error:', str(e))
             # return JsonResponse({'error': 'Invalid coordinates format or no coordinates provided'}, status=400)
             return redirect('/explorer/index')
 
-        traffic_accident_coordinates_set = coordinate_set(coordinates, 0.0001)
-        earthquake_coordinates_set = coordinate_set(coordinates, 0.01)
+        # The risk of each step of the route, if the browser sent the number
+        # of points of each step. The steps need all of the points, so they
+        # are determined before the route is simplified
+        try:
+            step_risk = _step_risk(request, Direction(coordinates))
+        except (json.JSONDecodeError, ValueError) as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
-        # Initialize risk counts
-        traffic_accident_number = 0
-        traffic_accident_fatality = 0
-        traffic_accident_injury = 0
-        earthquake_number = 0
-        earthquake_magnitudes = []
-        earthquake_depths = []
-        earthquake_data = []
-        earthquake_flag = True
+        # Most points of a route sent by the browser lie on a straight line
+        # with their neighbors, so they can be dropped before the lookup
+        dropped_point_number = 0
+        if request.POST.get('simplify', str(SIMPLIFY_ROUTES)).lower() == 'true':
+            coordinates, dropped_point_number = simplify(coordinates)
 
-        for loading_index in range(0, len(traffic_accident_coordinates_set), RISK_LOADING_NUMBER):
-            try:
-                traffic_accident_coordinates = traffic_accident_coordinates_set[loading_index: loading_index + RISK_LOADING_NUMBER]
-            except:
-                traffic_accident_coordinates = traffic_accident_coordinates_set[loading_index:]
-
-            direction = Direction(traffic_accident_coordinates)
-            traffic_accident_number += direction.traffic_accident.number
-            traffic_accident_fatality += direction.traffic_accident.total_fatality
-            traffic_accident_injury += direction.traffic_accident.total_injury
-
-            if earthquake_flag:
-                try:
-                    earthquake_coordinates = earthquake_coordinates_set[loading_index: loading_index + RISK_LOADING_NUMBER]
-                except:
-                    earthquake_coordinates = earthquake_coordinates_set[loading_index:]
-                    earthquake_flag = False
-
-                direction = Direction(earthquake_coordinates)
-
-                if direction.earthquake.data:
-                    earthquake_number += direction.earthquake.number
-                    earthquake_magnitudes += direction.earthquake.magnitude
-                    earthquake_depths += direction.earthquake.depth
-                for i in range(direction.earthquake.number):
-                    earthquake_data.append({
-                        "date": direction.earthquake.date[i],
-                        "coordinate": direction.earthquake.coordinate[i],
-                        "magnitude": direction.earthquake.magnitude[i],
-                        "depth": direction.earthquake.depth[i],
-                    })
+        # The points are kept in order, so that Direction can rasterize the
+        # segments between them at the grid of each kind of risk and resolve
+        # all of the cells in batched queries
+        direction = Direction(coordinates)
 
-                try:
-                    earthquake_average_magnitude = f"{average_magnitude(earthquake_magnitudes):.2f}"
-                    earthquake_average_depth = f"{average_depth(earthquake_depths):.2f}"
-                except:
-                    earthquake_average_magnitude = None
-                    earthquake_average_depth = None
+        # Near-identical routes pass through the same cells, so their risk is
+        # only determined once until the data is updated
+        cache = route_risk_cache()
+        key = route_risk_key(direction.traffic_accident.cells, direction.earthquake.cells)
+        data = cache.get(key)
+        if request.POST.get('stream', '').lower() == 'true' or \
+                'application/x-ndjson' in request.headers.get('Accept', ''):
+            return StreamingHttpResponse(_map_stream(direction, data, dropped_point_number, step_risk, key),
+                                         content_type='application/x-ndjson')
+        if data is not None:
+            data["dropped_point_number"] = dropped_point_number
+            if step_risk is not None:
+                data["traffic_accident_steps"] = step_risk()
+            return JsonResponse(data)
+
+        # The two kinds of risk have their own cells at their own grid, so
+        # they are looked up at the same time and joined at the end
+        fan_out = route_executor().fan_out()
+        traffic_accident = fan_out.submit(_traffic_accident_risk, direction)
+        earthquake = fan_out.submit(_earthquake_risk, direction)
+        data = {**traffic_accident.result(), **earthquake.result()}
+        cache.set(key, data)
+
+        data["dropped_point_number"] = dropped_point_number
+        if step_risk is not None:
+            data["traffic_accident_steps"] = step_risk()
+        return JsonResponse(data)
 
-            data = {
+    else:
+        context = {'api_key': GOOGLE_MAPS_API_KEY}
+        return render(request, 'map.html', context)
+
+def _step_risk(request, direction):
+    """This method is used to get a function which determines the traffic
+        accidents of each step of a route, see 'Direction.step_risk()', from
+        'step_point_numbers', a JSON list of the number of points of each
+        step sent with the coordinates.
+
+    The numbers are validated at once, so a bad request fails before any
+    lookup, while the lookup itself is left to the caller.
+
+    :return: The function, or None if no steps were sent.
+    :rtype: function or None"""
+
+    step_point_numbers = request.POST.get('step_point_numbers', '')
+    if not step_point_numbers:
+        return None
+    step_point_numbers = json.loads(step_point_numbers)
+    check_step_point_numbers(step_point_numbers, len(direction.coordinates))
+    return lambda: direction.step_risk(step_point_numbers)
+
+def _traffic_accident_risk(direction):
+    return {
+        "traffic_accident_number": direction.traffic_accident.number,
+        "traffic_accident_fatality": direction.traffic_accident.total_fatality,
+        "traffic_accident_injury": direction.traffic_accident.total_injury,
+    }
+
+def _earthquake_risk(direction):
+    if direction.earthquake.data:
+        earthquake_average_magnitude = f"{direction.earthquake.average_magnitude:.2f}"
+        earthquake_average_depth = f"{direction.earthquake.average_depth:.2f}"
+    else:
+        earthquake_average_magnitude = None
+        earthquake_average_depth = None
+    return {
+        "earthquake_number": direction.earthquake.number,
+        "earthquake_average_magnitude": earthquake_average_magnitude,
+        "earthquake_average_depth": earthquake_average_depth,
+        "earthquake_data": direction.earthquake.records(),
+    }
+
+def _chunks(cells, size):
+    return [cells[start: start + size] for start in range(0, len(cells), size)]
+
+def _stream_chunks(kind, open_source, lookup, cells, size, lines, stop):
+    # Look up the cells of one kind of risk of '_map_stream' chunk by chunk,
+    # and hand any error over as well so that it does not wait forever
+    try:
+        with open_source() as source:
+            for chunk in _chunks(cells, size):
+                if stop.is_set():
+                    break
+                lines.put((kind, getattr(source, lookup)(chunk)))
+    except BaseException as error:
+        lines.put(("error", error))
+        raise
+
+def _map_stream(direction, cached_data, dropped_point_number, step_risk=None, cache_key=None):
+    """This method is used to yield the risk of a route as NDJSON, one line
+        of running totals after each chunk of traffic accident or earthquake
+        cells, so the first totals are sent long before a long route is
+        finished.
+
+    Each kind of risk is looked up by its own task in 'route_executor()',
+    in chunks of its own size, and a line is sent whenever either of them
+    has finished a chunk. A line only carries the earthquakes of its own
+    chunk. Once every chunk has been looked up, the same data as that of a
+    response of 'map' is stored in the route risk cache, so a streamed
+    route is only determined once as well.
+
+    :param cached_data: The data of the route in the route risk cache, which
+        is sent as a single line if there is any.
+    :type cached_data: dict or None
+
+    :param step_risk: The function of '_step_risk()', whose steps are sent
+        with the last line.
+    :type step_risk: function or None
+
+    :param cache_key: The key of the route in the route risk cache, see
+        'cache.route_risk_key()', or None not to store it.
+    :type cache_key: str or None"""
+
+    if cached_data is not None:
+        line = {**cached_data, "dropped_point_number": dropped_point_number, "progress": 1, "done": True}
+        if step_risk is not None:
+            line["traffic_accident_steps"] = step_risk()
+        yield json.dumps(line, cls=DjangoJSONEncoder) + "\n"
+        return
+
+    traffic_accident_cells = direction.traffic_accident.cells
+    earthquake_cells = direction.earthquake.cells
+    chunk_number = math.ceil(len(traffic_accident_cells) / RISK_LOADING_NUMBER) + \
+        math.ceil(len(earthquake_cells) / EARTHQUAKE_LOADING_NUMBER)
+    traffic_accident_number = traffic_accident_fatality = traffic_accident_injury = 0
+    earthquake_number = 0
+    earthquake_magnitudes = []
+    earthquake_depth = 0
+    # The earthquakes by id, in the order of 'records()' for the cache
+    earthquake_records = {}
+
+    lines = queue.Queue()
+    stop = threading.Event()
+    fan_out = route_executor().fan_out()
+    futures = [fan_out.submit(_stream_chunks, "traffic_accident", traffic_accident_source,
+                              "aggregate_from_cells", traffic_accident_cells,
+                              RISK_LOADING_NUMBER, lines, stop),
+               fan_out.submit(_stream_chunks, "earthquake", EarthquakeSQLController,
+                              "select_from_cells", earthquake_cells,
+                              EARTHQUAKE_LOADING_NUMBER, lines, stop)]
+    try:
+        for index in range(max(chunk_number, 1)):
+            earthquake_data = []
+            if chunk_number:
+                kind, result = lines.get()
+                if kind == "error":
+                    raise result
+                elif kind == "traffic_accident":
+                    traffic_accident_number += result.number
+                    traffic_accident_fatality += result.total_fatality
+                    traffic_accident_injury += result.total_injury
+                else:
+                    for data in result:
+                        record = {
+                            "date": data[1],
+                            "coordinate": (data[3], data[4]),
+                            "magnitude": data[5],
+                            "depth": data[6],
+                        }
+                        earthquake_data.append(record)
+                        earthquake_records[data[0]] = record
+                        earthquake_number += 1
+                        earthquake_magnitudes.append(data[5])
+                        earthquake_depth += data[6]
+
+            if earthquake_number:
+                earthquake_average_magnitude = f"{risk.average_magnitude(earthquake_magnitudes):.2f}"
+                earthquake_average_depth = f"{earthquake_depth / earthquake_number:.2f}"
+            else:
+                earthquake_average_magnitude = None
+                earthquake_average_depth = None
+
+            line = {
                 "traffic_accident_number": traffic_accident_number,
                 "traffic_accident_fatality": traffic_accident_fatality,
                 "traffic_accident_injury": traffic_accident_injury,
                 "earthquake_number": earthquake_number,
                 "earthquake_average_magnitude": earthquake_average_magnitude,
                 "earthquake_average_depth": earthquake_average_depth,
-                "earthquake_data": earthquake_data
+                "earthquake_data": earthquake_data,
+                "dropped_point_number": dropped_point_number,
+                "progress": (index + 1) / max(chunk_number, 1),
+                "done": index >= chunk_number - 1
             }
-
-        return JsonResponse(data)
-
-    else:
-        context = {'api_key': GOOGLE_MAPS_API_KEY}
-        return render(request, 'map.html', context)
+            if line["done"]:
+                if cache_key is not None:
+                    route_risk_cache().set(cache_key, {
+                        "traffic_accident_number": traffic_accident_number,
+                        "traffic_accident_fatality": traffic_accident_fatality,
+                        "traffic_accident_injury": traffic_accident_injury,
+                        "earthquake_number": earthquake_number,
+                        "earthquake_average_magnitude": earthquake_average_magnitude,
+                        "earthquake_average_depth": earthquake_average_depth,
+                        "earthquake_data": [earthquake_records[id] for id in sorted(earthquake_records)],
+                    })
+                if step_risk is not None:
+                    line["traffic_accident_steps"] = step_risk()
+            yield json.dumps(line, cls=DjangoJSONEncoder) + "\n"
+    finally:
+        # The client may have gone away before the last line
+        stop.set()
+        for future in futures:
+            future.exception()
 
 @csrf_exempt
 def travel(request):
@@ -160,12 +326,16 @@ def travel_map(request):
         try:
             if not coordinates:
                 raise ValueError('No coordinates provided')
-            coordinates = json.loads(coordinates)
-        except (json.JSONDecodeError, ValueError) as e:
+            coordinates = CoordinateArray(json.loads(coordinates))
+        except (json.JSONDecodeError, ValueError, InvalidCoordinateError) as e:
             print('Error:', str(e))
             return JsonResponse({'error': 'Invalid coordinates format or no coordinates provided'}, status=400)
 
         direction = Direction(coordinates)
+        try:
+            step_risk = _step_risk(request, direction)
+        except (json.JSONDecodeError, ValueError) as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
         traffic_accident_number = direction.traffic_accident.number
         traffic_accident_fatality = direction.traffic_accident.total_fatality
@@ -179,14 +349,9 @@ def travel_map(request):
             earthquake_number = 0
             earthquake_average_magnitude = None
             earthquake_average_depth = None
-        earthquake_data = [{
-            "date": direction.earthquake.date[i],
-            "coordinate": direction.earthquake.coordinate[i],
-            "magnitude": direction.earthquake.magnitude[i],
-            "depth": direction.earthquake.depth[i],
-        } for i in range(earthquake_number)]
-
-        return JsonResponse({
+        earthquake_data = direction.earthquake.records()
+
+        data = {
             "traffic_accident_number": traffic_accident_number,
             "traffic_accident_fatality": traffic_accident_fatality,
             "traffic_accident_injury": traffic_accident_injury,
@@ -194,7 +359,22 @@ def travel_map(request):
             "earthquake_average_magnitude": earthquake_average_magnitude,
             "earthquake_average_depth": earthquake_average_depth,
             "earthquake_data": earthquake_data
-        })
+        }
+
+        # The risk of each part of the route, so the map can color the route
+        # without another request
+        segment_meters = request.POST.get('segment_meters', '')
+        if segment_meters:
+            # 'segment_risk()' rejects lengths which are not finite, shorter
+            # than a grid cell or split the route into too many parts
+            try:
+                data["traffic_accident_segments"] = direction.segment_risk(float(segment_meters))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+        if step_risk is not None:
+            data["traffic_accident_steps"] = step_risk()
+
+        return JsonResponse(data)
     else:
         start = request.GET.get('start', '')
         end = request.GET.get('end', '')
@@ -209,6 +389,136 @@ def travel_map(request):
 
         return render(request, 'travel_map.html', context)
 
+@require_POST
+def compare(request):
+    """This view is used to score several alternative routes in one request.
+
+    The routes are either sent as 'routes', a JSON list of lists of points,
+    or determined by the Directions API with 'alternatives' from 'start' and
+    'end'. The cells of all routes are looked up once, see 'Directions'.
+
+    It responds with 503 when the Directions API cannot be used, e.g.
+    without an API key, instead of scoring the sample route of
+    'DirectionAPI'."""
+
+    routes = request.POST.get('routes', '')
+    start = request.POST.get('start', '')
+    end = request.POST.get('end', '')
+    summaries = None
+    try:
+        if routes:
+            routes = json.loads(routes)
+            if not isinstance(routes, list):
+                raise ValueError('Routes must be a list of lists of coordinates')
+        elif start and end:
+            if not GOOGLE_MAPS_API_KEY:
+                return JsonResponse({'error': 'Directions are unavailable without a Google Maps API key'},
+                                    status=503)
+            direction_api = DirectionAPI(start, end, alternatives=True)
+            routes = direction_api.alternative_coordinates
+            summaries = [route.get('summary') for route in direction_api.routes]
+        else:
+            raise ValueError('No routes provided')
+        directions = Directions(routes)
+    except (json.JSONDecodeError, ValueError, InvalidCoordinateError) as e:
+        print('Error:', str(e))
+        return JsonResponse({'error': 'Invalid routes format or no routes provided'}, status=400)
+    except ApiError as e:
+        print('Error:', str(e))
+        status = 503 if e.status in DIRECTIONS_UNAVAILABLE_STATUSES else 400
+        return JsonResponse({'error': f'Directions API error: {e.status}'}, status=status)
+    except (Timeout, TransportError) as e:
+        print('Error:', str(e))
+        return JsonResponse({'error': 'Directions are unavailable'}, status=503)
+
+    data = []
+    for traffic_accident, earthquake in zip(directions.traffic_accident, directions.earthquake):
+        if earthquake["number"]:
+            earthquake_average_magnitude = f"{earthquake['average_magnitude']:.2f}"
+            earthquake_average_depth = f"{earthquake['average_depth']:.2f}"
+        else:
+            earthquake_average_magnitude = None
+            earthquake_average_depth = None
+        data.append({
+            "traffic_accident_number": traffic_accident.number,
+            "traffic_accident_fatality": traffic_accident.total_fatality,
+            "traffic_accident_injury": traffic_accident.total_injury,
+            "earthquake_number": earthquake["number"],
+            "earthquake_average_magnitude": earthquake_average_magnitude,
+            "earthquake_average_depth": earthquake_average_depth,
+        })
+    if summaries:
+        for route, summary in zip(data, summaries):
+            route["summary"] = summary
+
+    return JsonResponse({"routes": data, "cell_number": directions.cell_number})
+
+def _run_in_executor(function, *args, **kwargs):
+    """This method is used to run a blocking call which reads SQLite, in a
+        thread of 'database.route_executor()' without blocking the event
+        loop.
+
+    Django runs every synchronous view of an ASGI server in one shared
+    thread, so calls made here are thread insensitive instead. The database
+    connections come from 'database.connection_pool()', which may be used
+    from any thread. Requests to the Google Maps APIs must not be made here,
+    since the executor is sized for the database, not for slow HTTP."""
+
+    return sync_to_async(function, thread_sensitive=False, executor=route_executor())(*args, **kwargs)
+
+async def _async_streaming_content(streaming_content):
+    # Pull the lines of a synchronous streaming response one at a time in a
+    # worker thread, since Django would otherwise consume all of them first.
+    # '_map_stream' waits for its lookups in 'route_executor()', so it is
+    # not pulled in a thread of it
+    iterator = iter(streaming_content)
+    finished = object()
+    while True:
+        part = await sync_to_async(next, thread_sensitive=False)(iterator, finished)
+        if part is finished:
+            break
+        yield part
+
+async def map_async(request):
+    """This view is the asynchronous version of 'map' for ASGI servers, so a
+        single worker process serves many routes at once while their lookups
+        wait for the database."""
+
+    # 'map' itself waits for its lookups in 'route_executor()', so it must
+    # not take up a thread of it while doing so
+    response = await sync_to_async(map, thread_sensitive=False)(request)
+    if isinstance(response, StreamingHttpResponse) and not response.is_async:
+        response.streaming_content = _async_streaming_content(response.streaming_content)
+    return response
+
+async def travel_map_async(request):
+    """This view is the asynchronous version of 'travel_map'."""
+
+    return await _run_in_executor(travel_map, request)
+
+async def compare_async(request):
+    """This view is the asynchronous version of 'compare', which also keeps
+        the request of the Directions API off the event loop."""
+
+    # The request of the Directions API may take seconds, so it runs in the
+    # default executor of asgiref rather than taking a database thread
+    return await sync_to_async(compare, thread_sensitive=False)(request)
+
+@csrf_exempt
+async def travel_async(request):
+    """This view is the asynchronous version of 'travel'."""
+
+    return await _run_in_executor(travel, request)
+
+def executor_metrics(request):
+    """This view is used to get the metrics of 'database.route_executor()',
+        i.e. its size and the numbers of queued, running and completed
+        tasks, so that staff can see whether it is saturated."""
+
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    return JsonResponse(route_executor().metrics())
+
 def signin(request):
     if request.method == "GET":
         return render(request, "signin.html", {})
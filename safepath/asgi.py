@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "safepath.settings")
 
 application = get_asgi_application()
+
+# Build the in-memory risk indexes once per worker instead of on the first request
+from explorer.database import load_indexes
+
+load_indexes()
@@ -25,6 +25,23 @@ DATABASES = {
     )
 }
 
+# The risk of routes is cached in files shared by every worker process, see
+# 'explorer/cache.py'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'route_risk': {
+        'BACKEND': 'explorer.cache.LRUFileBasedCache',
+        'LOCATION': os.getenv('ROUTE_RISK_CACHE_PATH', os.path.join(BASE_DIR, 'cache', 'route_risk')),
+        'TIMEOUT': int(os.getenv('ROUTE_RISK_CACHE_TIMEOUT', 60 * 60)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('ROUTE_RISK_CACHE_MAX_ENTRIES', 1000)),
+            'CULL_FREQUENCY': 4,
+        },
+    },
+}
+
 STATIC_URL = '/static/'
 
 # Test: static path
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "safepath.settings")
 
 application = get_wsgi_application()
+
+# Build the in-memory risk indexes once per worker instead of on the first request
+from explorer.database import load_indexes
+
+load_indexes()